@@ -0,0 +1,146 @@
+import hashlib
+import os
+
+import librosa
+import numpy as np
+import soundfile
+
+
+# how many entries a process adds before it looks at the size on disk again
+RESCAN_STORES = 64
+
+
+class AudioCache:
+    """On-disk cache of decoded (and possibly resampled) audio.
+
+    Entries are .npy files keyed by file path, modification time and sample
+    rate, so changed files or different rates never give stale data. Cached
+    arrays are returned memory-mapped. If the cache grows beyond its size
+    limit, the least recently used entries are removed.
+
+    The cache only keeps state on disk, so it can be shared between
+    processes. The size limit applies to the cache as a whole: each process
+    keeps a running total, which is refreshed from the directory every
+    RESCAN_STORES entries it adds (and before evicting). Entries added by
+    other processes are only counted from then on, so with n processes the
+    cache can overshoot by up to n * RESCAN_STORES entries for a while.
+    """
+
+    def __init__(self, cache_dir, max_mb=None):
+        """
+        Parameters:
+            cache_dir: Folder to store the cached arrays in. Created if it
+                       doesn't exist.
+            max_mb: Optional size limit of the cache in megabytes.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 2**20 if max_mb else None
+        self._size = None  # running total, see _store
+        self._stores_since_scan = 0
+
+    def load(self, filename, sr=None):
+        """Drop-in replacement for librosa.load(filename, sr=sr).
+
+        Parameters:
+            filename: Path to the audio file.
+            sr: Rate to resample to. If None, the native rate is used.
+
+        Returns:
+            Sequence (float32, possibly memory-mapped) and sampling rate.
+        """
+        if sr is None:  # need to know the rate for the key
+            sr = soundfile.info(filename).samplerate
+        path = self._entry_path(filename, sr)
+        try:
+            seq = np.load(path, mmap_mode="r")
+            os.utime(path)  # mark as recently used
+            return seq, sr
+        except (IOError, ValueError):  # not cached (yet) or broken
+            pass
+
+        seq, sr = librosa.load(filename, sr=sr)
+        self._store(path, seq)
+        return seq, sr
+
+    def _entry_path(self, filename, sr):
+        stat = os.stat(filename)
+        key = "{}|{}|{}|{}".format(os.path.abspath(filename), stat.st_mtime_ns,
+                                   stat.st_size, sr)
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def _store(self, path, seq):
+        # write to a temporary file first so other processes never see
+        # half-written entries
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, mode="wb") as tmp_file:
+            np.save(tmp_file, seq)
+        os.replace(tmp_path, path)
+
+        if self.max_bytes:
+            self._stores_since_scan += 1
+            if self._size is None or \
+                    self._stores_since_scan >= RESCAN_STORES:
+                self._rescan()
+            else:
+                self._size += os.path.getsize(path)
+            if self._size > self.max_bytes:
+                # other processes may have evicted already
+                entries = self._rescan()
+                if self._size > self.max_bytes:
+                    self._evict(entries)
+
+    def _rescan(self):
+        """Refresh the running total from the directory; returns entries."""
+        entries = self._entries()
+        self._size = sum(size for _, size, _ in entries)
+        self._stores_since_scan = 0
+        return entries
+
+    def _entries(self):
+        """List of (last use, size, path) for all cache entries."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:  # removed by another process in the meantime
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self, entries):
+        """Remove least recently used entries until we are at 90% capacity.
+
+        Parameters:
+            entries: Current cache entries, see _entries.
+        """
+        entries = sorted(entries)
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+
+def load_audio(filename, sr=None, cache=None):
+    """librosa.load that reads through an AudioCache if one is given."""
+    if cache is not None:
+        return cache.load(filename, sr=sr)
+    return librosa.load(filename, sr=sr)
+
+
+def cache_from_config(config_dict):
+    """Create the AudioCache requested in a data config (or None)."""
+    if config_dict["audio_cache"]:
+        return AudioCache(config_dict["audio_cache"],
+                          config_dict["audio_cache_mb"])
+    return None
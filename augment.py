@@ -0,0 +1,195 @@
+import functools
+import multiprocessing
+
+import numpy as np
+
+from audio_cache import load_audio
+
+
+class AugmentationPool:
+    """Training clips kept in memory to create new examples by mixing them.
+
+    All clips live in one flat array (float16 by default to halve memory)
+    with offsets and lengths, so mixes can be created for a whole batch at
+    once with fancy indexing instead of clip by clip.
+
+    Like the original augmentation, each mix combines two clips which are
+    birds with probability p_pick_birds each. This probability is chosen such
+    that the proportion of positive mixes is the same as in the data. The
+    shorter clip is randomly padded to the length of the longer one.
+    """
+
+    def __init__(self, clips, labels, transform=None, dtype=np.float16,
+                 names=None, rates=None):
+        """
+        Parameters:
+            clips: List of 1D numpy arrays (raw audio).
+            labels: List of ints, same length as clips.
+            transform: Transformation function to apply to the mixes. If None,
+                       the mixes are returned raw (with a fake channel axis).
+            dtype: Type to store the audio as.
+            names: Optional list of source file names of the clips.
+            rates: Optional list of sampling rates of the clips.
+        """
+        self.lengths = np.array([len(clip) for clip in clips], dtype=np.int64)
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+        self.data = np.empty(self.lengths.sum(), dtype=dtype)
+        for offset, clip in zip(self.offsets, clips):
+            self.data[offset:(offset + len(clip))] = clip
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.transform = transform
+        self.names = names
+        self.rates = None if rates is None else np.asarray(rates)
+
+        self.bird_inds = np.flatnonzero(self.labels)
+        self.noise_inds = np.flatnonzero(self.labels == 0)
+        if not len(self.bird_inds) or not len(self.noise_inds):
+            raise ValueError("Need both bird and noise clips for "
+                             "augmentation!")
+        prop_birds = len(self.bird_inds) / len(self.labels)
+        self.p_pick_birds = 1 - np.sqrt(1 - prop_birds)
+
+    @classmethod
+    def from_data_list(cls, data_list, inds, resample_rate=None,
+                       transform=None, cache=None, n_workers=1,
+                       max_seconds=20, dtype=np.float16):
+        """Load a pool from (part of) a data list.
+
+        Parameters:
+            data_list: List of filename, label pairs.
+            inds: Indices into data_list of the clips to use (i.e. the
+                  training set).
+            resample_rate: Optional int giving the Hz to resample the data to.
+            transform: See __init__.
+            cache: Optional AudioCache to read the files through.
+            n_workers: Number of processes to load the files with.
+            max_seconds: Longer clips are left out, just like in the regular
+                         data.
+            dtype: See __init__. Clips are converted as soon as they are
+                   loaded to keep memory usage down.
+
+        Returns:
+            The pool.
+        """
+        print("Loading {} clips for augmentation...".format(len(inds)))
+        load = functools.partial(_load_clip, resample_rate=resample_rate,
+                                 cache=cache, max_seconds=max_seconds)
+        filenames = [data_list[ind][0] for ind in inds]
+        clips = []
+        labels = []
+        names = []
+        rates = []
+        for ind, loaded in zip(inds, _imap(load, filenames, n_workers)):
+            if loaded is not None:
+                clips.append(loaded[0].astype(dtype))
+                rates.append(loaded[1])
+                names.append(data_list[ind][0])
+                labels.append(data_list[ind][1])
+        print("Kept {} clips for augmentation.".format(len(clips)))
+        return cls(clips, labels, transform=transform, dtype=dtype,
+                   names=names, rates=rates)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def mix_batch(self, n, rng=None):
+        """Create a batch of raw mixes.
+
+        Parameters:
+            n: How many mixes to create.
+            rng: np.random.RandomState to use. If not given, the global numpy
+                 random state is used.
+
+        Returns:
+            List of n 1D float32 arrays, array of n labels and the two arrays
+            of n indices of the clips that were mixed.
+        """
+        rng = rng or np.random
+        picks = [self._pick(n, rng), self._pick(n, rng)]
+        lengths = [self.lengths[pick] for pick in picks]
+        longer = np.maximum(*lengths)
+        mix_offsets = np.cumsum(longer) - longer
+
+        mixed = np.zeros(longer.sum(), dtype=np.float32)
+        for pick, length in zip(picks, lengths):
+            # random position of each clip within its mix
+            starts = (rng.random_sample(n) *
+                      (longer - length + 1)).astype(np.int64)
+            within = np.arange(length.sum()) - np.repeat(
+                np.cumsum(length) - length, length)
+            targets = np.repeat(mix_offsets + starts, length) + within
+            sources = np.repeat(self.offsets[pick], length) + within
+            mixed[targets] += 0.5 * self.data[sources]
+
+        labels = np.maximum(self.labels[picks[0]], self.labels[picks[1]])
+        return np.split(mixed, mix_offsets[1:]), labels, picks
+
+    def generate(self, n_examples, batch_size=32, rng=None):
+        """Generate augmented examples.
+
+        Parameters:
+            n_examples: Exactly this many examples are generated. If None,
+                        generate forever.
+            batch_size: How many mixes to create (and transform) at once.
+                        The raw mixes of a batch are kept in memory together,
+                        so this shouldn't be too large.
+            rng: See mix_batch.
+
+        Returns:
+            Generator over transformed sequences (2D), labels, sources (names
+            of the mixed files, joined by "+"; empty if names are not known)
+            and durations in seconds (NaN if rates are not known).
+        """
+        n_done = 0
+        while n_examples is None or n_done < n_examples:
+            n_batch = batch_size if n_examples is None else min(
+                batch_size, n_examples - n_done)
+            mixes, labels, (picks1, picks2) = self.mix_batch(n_batch, rng)
+            if hasattr(self.transform, "transform_batch"):
+                seqs = self.transform.transform_batch(mixes)
+            elif self.transform:
+                seqs = [self.transform(mix) for mix in mixes]
+            else:  # raw: Add fake channel axis
+                seqs = [mix[None, :] for mix in mixes]
+            for seq, label, pick1, pick2 in zip(seqs, labels, picks1, picks2):
+                yield seq, int(label), self._source(pick1, pick2), \
+                    self._duration(pick1, pick2)
+            n_done += n_batch
+
+    def _source(self, pick1, pick2):
+        if self.names is None:
+            return ""
+        return self.names[pick1] + "+" + self.names[pick2]
+
+    def _duration(self, pick1, pick2):
+        if self.rates is None:
+            return np.nan
+        return max(self.lengths[pick1] / self.rates[pick1],
+                   self.lengths[pick2] / self.rates[pick2])
+
+    def _pick(self, n, rng):
+        """Pick n clip indices, each a bird with prob. p_pick_birds."""
+        birds = self.bird_inds[rng.randint(len(self.bird_inds), size=n)]
+        noise = self.noise_inds[rng.randint(len(self.noise_inds), size=n)]
+        return np.where(rng.random_sample(n) < self.p_pick_birds, birds, noise)
+
+
+def _imap(func, iterable, n_workers):
+    """Ordered map, in a pool of worker processes if n_workers > 1."""
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers) as pool:
+            yield from pool.imap(func, iterable, chunksize=8)
+    else:
+        yield from map(func, iterable)
+
+
+def _load_clip(filename, resample_rate, cache, max_seconds):
+    """Load a clip with its rate, returning None if it's too long or broken."""
+    try:
+        seq, sr = load_audio(filename, sr=resample_rate, cache=cache)
+    except Exception as err:
+        print("Could not load {}, skipping it: {}".format(filename, err))
+        return None
+    if len(seq) / sr > max_seconds:
+        return None
+    return seq, sr
@@ -0,0 +1,570 @@
+# benchmarks for the data pipeline and model; everything runs on synthetic
+# data
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_utils import RECORD_VERSIONS, mel_transform, prepare_frontend, \
+    prepare_transform, read_data_config, stft_transform, tfrecord_path, \
+    time_steps
+from est_input import input_fn, parse_example
+from est_models import SCORE_KEYS, model_fn
+from make_tfrecords import make_example
+
+
+def synthetic_spectrograms(config_dict, n_examples, min_seconds=3.,
+                           max_seconds=20., seed=0):
+    """Create random arrays shaped like the transformed data of a config.
+
+    Parameters:
+        config_dict: Data config as returned by read_data_config.
+        n_examples: How many arrays to create.
+        min_seconds: Shortest "clip" to simulate.
+        max_seconds: Longest "clip" to simulate.
+        seed: For the random number generator.
+
+    Returns:
+        List of float32 arrays freqs x time.
+    """
+    rng = np.random.RandomState(seed)
+    sr = config_dict["resample_rate"] or 44100
+    if config_dict["data_type"] == "mel":
+        freqs = config_dict["mel_freqs"]
+        hop = config_dict["hop_length"]
+    elif config_dict["data_type"] == "stft":
+        freqs = config_dict["window_size"] // 2 + 1
+        hop = config_dict["hop_length"]
+    else:
+        freqs = 1
+        hop = 1
+    seqs = []
+    for seconds in rng.uniform(min_seconds, max_seconds, size=n_examples):
+        frames = int(seconds * sr / hop) + 1
+        seqs.append(rng.normal(scale=3., size=(freqs, frames)).astype(
+            np.float32))
+    return seqs
+
+
+def time_parsing(paths, threshold=False, repeats=3, frontend=None):
+    """Measure how many records per second parse_example gets through.
+
+    Parameters:
+        paths: List of TFRecords files to parse.
+        threshold: Passed to parse_example.
+        repeats: How often to go through the data. The best run counts.
+        frontend: Passed to parse_example.
+
+    Returns:
+        Records per second.
+    """
+    with tf.Graph().as_default():
+        data = tf.data.TFRecordDataset(paths)
+        data = data.map(lambda x: parse_example(x, threshold,
+                                                frontend=frontend))
+        # reduce to scalars so we don't measure copying to Python
+        data = data.map(lambda seq, label: tf.reduce_sum(seq))
+        data = data.batch(256)
+        iterator = data.make_initializable_iterator()
+        next_batch = iterator.get_next()
+        best = float("inf")
+        with tf.Session() as sess:
+            for _ in range(repeats):
+                sess.run(iterator.initializer)
+                n_records = 0
+                start = time.time()
+                try:
+                    while True:
+                        n_records += len(sess.run(next_batch))
+                except tf.errors.OutOfRangeError:
+                    pass
+                best = min(best, time.time() - start)
+    return n_records / best
+
+
+def bench_record_formats(config_dict, n_examples, out_dir):
+    """Compare file size and parsing speed of all record formats.
+
+    Parameters:
+        config_dict: Data config to take shapes from.
+        n_examples: Number of synthetic examples to write per format.
+        out_dir: Where to put the temporary TFRecords files.
+
+    Returns:
+        Dict mapping record formats to dicts of results.
+    """
+    seqs = synthetic_spectrograms(config_dict, n_examples)
+    results = dict()
+    for record_format in sorted(RECORD_VERSIONS,
+                                key=lambda f: RECORD_VERSIONS[f]):
+        path = os.path.join(out_dir, record_format + ".tfrecords")
+        with tf.python_io.TFRecordWriter(path) as writer:
+            for seq in seqs:
+                writer.write(make_example(seq, 0, record_format))
+        results[record_format] = {
+            "file_size_mb": os.path.getsize(path) / 2**20,
+            "records_per_sec": time_parsing([path])}
+        print("{:>10}: {:8.1f} MB, {:8.1f} records/sec".format(
+            record_format, results[record_format]["file_size_mb"],
+            results[record_format]["records_per_sec"]))
+    return results
+
+
+def model_params(model_config, data_format="channels_last", onedim=False):
+    """Model parameters (see est_models.model_fn) for benchmarks.
+
+    These are fixed settings, not the defaults of est_cli: batch norm,
+    regularization, gradient clipping and visualizations are off so only the
+    network itself is timed. channels_last is the default because
+    channels_first does not run on CPU.
+    """
+    return {"model_config": model_config,
+            "act": tf.nn.relu,
+            "use_bn": False,
+            "data_format": data_format,
+            "adam_args": [1e-3, 0.9, 0.9, 1e-8],
+            "clipping": 0.,
+            "vis": 0,
+            "reg": 0.,
+            "onedim": onedim,
+            "label_smoothing": 0.,
+            "normalize": False,
+            "renorm": False,
+            "use_avg": False}
+
+
+def freqs_of(config_dict):
+    """Size of the frequency axis for a data config, like in est_main."""
+    if config_dict["data_type"] == "mel":
+        return config_dict["mel_freqs"]
+    elif config_dict["data_type"] == "stft":
+        return config_dict["window_size"] // 2 + 1
+    return 1
+
+
+def write_synthetic_records(config_dict, n_examples, base_path, subset="dev",
+                            record_format="float32"):
+    """Write synthetic examples to a TFRecords file usable by input_fn.
+
+    Returns:
+        Path of the file.
+    """
+    path = tfrecord_path(base_path, subset)
+    with tf.python_io.TFRecordWriter(path) as writer:
+        for ind, seq in enumerate(synthetic_spectrograms(config_dict,
+                                                         n_examples)):
+            writer.write(make_example(seq, ind % 2, record_format, ind))
+    return path
+
+
+def _predict_worker(base_path, freqs, model_config, batch_size, fetch_all,
+                    queue):
+    """Run predictions over synthetic dev data; report speed and memory."""
+    with tf.Graph().as_default():
+        features, labels = input_fn(base_path, "dev", batch_size, freqs,
+                                    augment=False, threshold=False)
+        spec = model_fn(features, labels, tf.estimator.ModeKeys.PREDICT,
+                        model_params(model_config), config=None)
+        if fetch_all:
+            fetches = spec.predictions
+        else:
+            fetches = {k: spec.predictions[k] for k in SCORE_KEYS}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            n_examples = 0
+            start = time.time()
+            try:
+                while True:
+                    n_examples += len(sess.run(fetches)["logits"])
+            except tf.errors.OutOfRangeError:
+                pass
+            elapsed = time.time() - start
+    queue.put({"examples_per_sec": n_examples / elapsed,
+               "peak_rss_mb": resource.getrusage(
+                   resource.RUSAGE_SELF).ru_maxrss / 2**10})
+
+
+def bench_predict_outputs(config_dict, model_config, n_examples, out_dir,
+                          batch_size=64):
+    """Compare fetching only scores with fetching all activations.
+
+    Each variant runs in a fresh process so peak memory can be compared.
+
+    Parameters:
+        config_dict: Data config to take shapes from.
+        model_config: Path to model config file.
+        n_examples: Number of synthetic examples to predict on.
+        out_dir: Where to put the temporary TFRecords file.
+        batch_size: Batch size for prediction.
+
+    Returns:
+        Dict mapping "scores" and "activations" to dicts of results.
+    """
+    base_path = os.path.join(out_dir, "synthetic")
+    write_synthetic_records(config_dict, n_examples, base_path)
+    context = multiprocessing.get_context("spawn")
+    results = dict()
+    for name, fetch_all in [("scores", False), ("activations", True)]:
+        queue = context.Queue()
+        worker = context.Process(
+            target=_predict_worker,
+            args=(base_path, freqs_of(config_dict), model_config, batch_size,
+                  fetch_all, queue))
+        worker.start()
+        results[name] = queue.get()
+        worker.join()
+        print("{:>11}: {:8.1f} examples/sec, peak RSS {:8.1f} MB".format(
+            name, results[name]["examples_per_sec"],
+            results[name]["peak_rss_mb"]))
+    return results
+
+
+def synthetic_audio(config_dict, n_examples, min_seconds=3., max_seconds=20.,
+                    seed=0):
+    """Create random 1D float32 "clips" at the sampling rate of a config."""
+    rng = np.random.RandomState(seed)
+    sr = config_dict["resample_rate"] or 44100
+    return [rng.normal(scale=0.1, size=int(seconds * sr)).astype(np.float32)
+            for seconds in rng.uniform(min_seconds, max_seconds,
+                                       size=n_examples)]
+
+
+def bench_features(config_dict, n_examples, batch_size=64):
+    """Compare the librosa transforms with features.FeatureExtractor.
+
+    Differences are only small if the config has no log_floor_db, since the
+    librosa transforms don't have that.
+
+    Parameters:
+        config_dict: Data config with data_type stft or mel.
+        n_examples: Number of synthetic clips to transform.
+        batch_size: How many clips the extractor gets at once in the batched
+                    variant.
+
+    Returns:
+        Dict mapping variants to dicts of results.
+    """
+    if config_dict["data_type"] == "mel":
+        reference = functools.partial(
+            mel_transform, sr=config_dict["resample_rate"] or 44100,
+            window_size=config_dict["window_size"],
+            hop_length=config_dict["hop_length"],
+            mel_freqs=config_dict["mel_freqs"])
+    elif config_dict["data_type"] == "stft":
+        reference = functools.partial(
+            stft_transform, window_size=config_dict["window_size"],
+            hop_length=config_dict["hop_length"])
+    else:
+        raise ValueError("Feature benchmark needs data_type stft or mel.")
+    extractor = prepare_transform(config_dict)
+    clips = synthetic_audio(config_dict, n_examples)
+
+    def batched(seqs):
+        out = []
+        for ind in range(0, len(seqs), batch_size):
+            out += extractor.transform_batch(seqs[ind:ind + batch_size])
+        return out
+
+    variants = [("librosa", lambda seqs: [reference(seq) for seq in seqs]),
+                ("extractor", lambda seqs: [extractor(seq) for seq in seqs]),
+                ("batched", batched)]
+    results = dict()
+    outputs = dict()
+    for name, run in variants:
+        start = time.time()
+        outputs[name] = run(clips)
+        results[name] = {"clips_per_sec": n_examples / (time.time() - start)}
+    for name, _ in variants:
+        results[name]["max_abs_diff"] = float(max(
+            np.abs(ours - ref).max() for ours, ref in
+            zip(outputs[name], outputs["librosa"])))
+        print("{:>9}: {:8.1f} clips/sec, max. abs. difference {:.2e}".format(
+            name, results[name]["clips_per_sec"],
+            results[name]["max_abs_diff"]))
+    return results
+
+
+def bench_frontend(config_dict, n_examples, out_dir):
+    """Compare reading precomputed features with computing them on-graph.
+
+    Parameters:
+        config_dict: Data config with data_type raw and a frontend.
+        n_examples: Number of synthetic clips.
+        out_dir: Where to put the temporary TFRecords files.
+
+    Returns:
+        Dict mapping "precomputed" and "frontend" to dicts of results.
+    """
+    frontend = prepare_frontend(config_dict)
+    if frontend is None:
+        raise ValueError("Frontend benchmark needs a data config with a "
+                         "frontend.")
+    clips = synthetic_audio(config_dict, n_examples)
+    results = dict()
+    for name, seqs in [("precomputed", frontend.transform_batch(clips)),
+                       ("frontend", [clip[None, :] for clip in clips])]:
+        path = os.path.join(out_dir, name + ".tfrecords")
+        with tf.python_io.TFRecordWriter(path) as writer:
+            for seq in seqs:
+                writer.write(make_example(seq, 0, "float32"))
+        results[name] = {
+            "file_size_mb": os.path.getsize(path) / 2**20,
+            "records_per_sec": time_parsing(
+                [path], frontend=frontend if name == "frontend" else None)}
+        print("{:>11}: {:8.1f} MB, {:8.1f} records/sec".format(
+            name, results[name]["file_size_mb"],
+            results[name]["records_per_sec"]))
+    return results
+
+
+def bench_training_steps(config_dict, model_config, n_examples, out_dir,
+                         batch_size=64, n_steps=50):
+    """Compare file size and training speed for float32 and float16 records.
+
+    Parameters:
+        config_dict: Data config to take shapes from.
+        model_config: Path to model config file.
+        n_examples: Number of synthetic examples to write per format.
+        out_dir: Where to put the temporary TFRecords files.
+        batch_size: Batch size for training.
+        n_steps: Number of training steps to time (after a few warmup steps).
+
+    Returns:
+        Dict mapping record formats to dicts of results.
+    """
+    results = dict()
+    for record_format in ["float32", "float16"]:
+        base_path = os.path.join(out_dir, record_format)
+        path = write_synthetic_records(config_dict, n_examples, base_path,
+                                       subset="train",
+                                       record_format=record_format)
+        with tf.Graph().as_default():
+            features, labels = input_fn(base_path, "train", batch_size,
+                                        freqs_of(config_dict), augment=False,
+                                        threshold=False)
+            spec = model_fn(features, labels, tf.estimator.ModeKeys.TRAIN,
+                            model_params(model_config), config=None)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                for _ in range(5):
+                    sess.run(spec.train_op)
+                start = time.time()
+                for _ in range(n_steps):
+                    sess.run(spec.train_op)
+                elapsed = time.time() - start
+        results[record_format] = {
+            "file_size_mb": os.path.getsize(path) / 2**20,
+            "steps_per_sec": n_steps / elapsed}
+        print("{:>8}: {:8.1f} MB, {:8.2f} steps/sec".format(
+            record_format, results[record_format]["file_size_mb"],
+            results[record_format]["steps_per_sec"]))
+    return results
+
+
+def time_input_fn(base_path, freqs, batch_size, n_batches=50):
+    """Measure batches per second of the full training input pipeline.
+
+    Parameters:
+        base_path: BASE path of TFRecords with a train subset.
+        freqs: See input_fn.
+        batch_size: See input_fn.
+        n_batches: How many batches to time (after a few warmup batches).
+
+    Returns:
+        Batches per second.
+    """
+    with tf.Graph().as_default():
+        features, labels = input_fn(base_path, "train", batch_size, freqs,
+                                    augment=False, threshold=False)
+        with tf.Session() as sess:
+            for _ in range(5):
+                sess.run([features, labels])
+            start = time.time()
+            for _ in range(n_batches):
+                sess.run([features, labels])
+            return n_batches / (time.time() - start)
+
+
+def time_model_step(model_config, freqs, batch_size, n_time_steps,
+                    data_format, onedim, train, n_steps=20):
+    """Measure examples per second of the model alone, on a fixed batch.
+
+    Parameters:
+        model_config: Path to model config file.
+        freqs: Size of the frequency axis.
+        batch_size: Number of examples per step.
+        n_time_steps: Length of the examples.
+        data_format, onedim: See model_fn.
+        train: If set, time training steps (forward and backward);
+               otherwise only the forward pass.
+        n_steps: How many steps to time (after a few warmup steps).
+
+    Returns:
+        Examples per second.
+    """
+    with tf.Graph().as_default():
+        rng = np.random.RandomState(0)
+        features = tf.constant(rng.normal(
+            size=(batch_size, 1, freqs, n_time_steps)).astype(np.float32))
+        labels = tf.constant(rng.randint(2, size=(batch_size, 1)).astype(
+            np.int32))
+        mode = tf.estimator.ModeKeys.TRAIN if train else \
+            tf.estimator.ModeKeys.PREDICT
+        spec = model_fn(features, labels, mode,
+                        model_params(model_config, data_format, onedim),
+                        config=None)
+        fetch = spec.train_op if train else spec.predictions["logits"]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(3):
+                sess.run(fetch)
+            start = time.time()
+            for _ in range(n_steps):
+                sess.run(fetch)
+            return n_steps * batch_size / (time.time() - start)
+
+
+def bench_suite(config_dict, model_config, n_examples, out_dir,
+                batch_size=64, clip_seconds=10.):
+    """Time parsing, the input pipeline and model steps separately.
+
+    Model steps are timed for each data_format and onedim setting. Settings
+    that don't run on this machine (e.g. channels_first on CPU) get their
+    error message instead of a number.
+
+    Parameters:
+        config_dict: Data config to take shapes from.
+        model_config: Path to model config file.
+        n_examples: Number of synthetic examples to write.
+        out_dir: Where to put the temporary TFRecords files.
+        batch_size: Batch size for input pipeline and model.
+        clip_seconds: Length of the examples for the model steps.
+
+    Returns:
+        Dict of results.
+    """
+    freqs = freqs_of(config_dict)
+    base_path = os.path.join(out_dir, "suite")
+    path = write_synthetic_records(config_dict, n_examples, base_path,
+                                   subset="train")
+    results = {"parse_records_per_sec": time_parsing([path]),
+               "input_fn_batches_per_sec": time_input_fn(base_path, freqs,
+                                                         batch_size),
+               "model": dict()}
+    print("{:>30}: {:8.1f}".format("parse_example records/sec",
+                                   results["parse_records_per_sec"]))
+    print("{:>30}: {:8.1f}".format("input_fn batches/sec",
+                                   results["input_fn_batches_per_sec"]))
+
+    n_time_steps = time_steps(clip_seconds, 44100, config_dict)
+    for data_format in ["channels_last", "channels_first"]:
+        for onedim in [False, True]:
+            name = data_format + ("_onedim" if onedim else "")
+            results["model"][name] = dict()
+            for step, train in [("forward", False), ("forward_backward",
+                                                     True)]:
+                try:
+                    speed = time_model_step(model_config, freqs, batch_size,
+                                            n_time_steps, data_format,
+                                            onedim, train)
+                    print("{:>30}: {:8.1f} examples/sec".format(
+                        name + " " + step, speed))
+                except tf.errors.OpError as err:
+                    speed = {"error": err.message}
+                    print("{:>30}: not supported here".format(
+                        name + " " + step))
+                results["model"][name][step + "_examples_per_sec"] = speed
+    return results
+
+
+def run_info(args):
+    """What a benchmark run was about: arguments, code version, machine."""
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"arguments": vars(args),
+            "commit": commit,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "machine": platform.platform(),
+            "processor": platform.processor(),
+            "n_cpus": os.cpu_count(),
+            "tensorflow": tf.__version__,
+            "gpu": tf.test.is_gpu_available()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks on synthetic data shaped like a data config.")
+    parser.add_argument("benchmark",
+                        choices=["records", "predict", "features",
+                                 "frontend", "steps", "suite"],
+                        help="Which benchmark to run. 'records' compares the "
+                             "TFRecords formats. 'predict' compares fetching "
+                             "only scores vs. all activations in prediction. "
+                             "'features' compares the librosa transforms "
+                             "with the vectorized feature extractor. "
+                             "'frontend' compares reading precomputed "
+                             "features with computing them from raw records "
+                             "on-graph. 'steps' compares training speed with "
+                             "float32 and float16 records. 'suite' times "
+                             "parsing, the input pipeline and model steps for "
+                             "all data formats separately.")
+    parser.add_argument("data_config",
+                        help="Path to data config file to take shapes "
+                             "from, e.g. data_configs/original.")
+    parser.add_argument("-n", "--n_examples",
+                        type=int,
+                        default=500,
+                        help="Number of synthetic examples. Default: 500.")
+    parser.add_argument("-m", "--model_config",
+                        default="model_configs/original",
+                        help="Path to model config file for model benchmarks."
+                             " Default: model_configs/original.")
+    parser.add_argument("-B", "--batch_size",
+                        type=int,
+                        default=64,
+                        help="Batch size for model benchmarks (and the "
+                             "batched feature extractor). Default: 64.")
+    parser.add_argument("-j", "--json",
+                        help="Also write the results, with the git commit "
+                             "and machine info, to this json file.")
+    args = parser.parse_args()
+
+    config = read_data_config(args.data_config)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.benchmark == "records":
+            RESULTS = bench_record_formats(config, args.n_examples, tmp_dir)
+        elif args.benchmark == "predict":
+            RESULTS = bench_predict_outputs(config, args.model_config,
+                                            args.n_examples, tmp_dir,
+                                            args.batch_size)
+        elif args.benchmark == "features":
+            RESULTS = bench_features(config, args.n_examples, args.batch_size)
+        elif args.benchmark == "frontend":
+            RESULTS = bench_frontend(config, args.n_examples, tmp_dir)
+        elif args.benchmark == "steps":
+            RESULTS = bench_training_steps(config, args.model_config,
+                                           args.n_examples, tmp_dir,
+                                           args.batch_size)
+        elif args.benchmark == "suite":
+            RESULTS = bench_suite(config, args.model_config, args.n_examples,
+                                  tmp_dir, args.batch_size)
+
+    if args.json:
+        with open(args.json, mode="w") as json_file:
+            json.dump(dict(run_info(args), results=RESULTS), json_file,
+                      indent=2, sort_keys=True)
+        print("Results written to {}.".format(args.json))
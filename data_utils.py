@@ -1,9 +1,16 @@
+import functools
+import hashlib
 import itertools
+import json
+import multiprocessing
 import os
 
 import librosa
 import numpy as np
 
+from audio_cache import load_audio
+from features import FeatureExtractor
+
 
 def make_labeled_data_list(base_path, sets, n_max=0):
     """Create a list of wave files with labels.
@@ -48,6 +55,51 @@ def extract_labels(base_path, dataset):
     return label_map
 
 
+def file_id(filename):
+    """Stable ID of a data file, to identify its examples in TFRecords.
+
+    Only the dataset folder and the file name go into the ID, so it does not
+    change when the data directory is moved or files are reordered.
+
+    Parameters:
+        filename: Path to the file.
+
+    Returns:
+        Non-negative int that fits into an int64.
+    """
+    return int(hashlib.sha1(file_key(filename).encode()).hexdigest()[:15], 16)
+
+
+def file_key(filename):
+    """Stable name of a data file: dataset folder and file name."""
+    return "/".join(os.path.normpath(filename).split(os.sep)[-2:])
+
+
+def match_predictions(predictions, dev_data, dev_ids=None):
+    """Pair predictions on the dev set with the files they belong to.
+
+    Parameters:
+        predictions: Iterable over prediction dicts with the example ID under
+                     "id", in the order of the dev records.
+        dev_data: List of filename, label pairs for the dev records, e.g.
+                  from their index (see read_index).
+        dev_ids: Example IDs for the entries of dev_data, e.g. the "id"
+                 column of the index. Predictions are matched by ID; those
+                 without one (records from before IDs existed), or all of
+                 them if this is None, are matched by position.
+
+    Returns:
+        Generator over tuples predictions, filename, label.
+    """
+    rows_by_id = dict() if dev_ids is None else {
+        int(example_id): row for row, example_id in enumerate(dev_ids)
+        if example_id >= 0}
+    for position, prediction in enumerate(predictions):
+        filename, label = dev_data[rows_by_id.get(int(prediction["id"]),
+                                                  position)]
+        yield prediction, filename, label
+
+
 def make_unlabeled_data_list(wav_dir):
     """Make a data list for the test set with "dummy" labels.
 
@@ -64,7 +116,10 @@ def make_unlabeled_data_list(wav_dir):
 
 DATA_CONFIG_REQUIRED_ENTRIES = {"tfr_path", "data_dir", "datasets",
                                 "data_type", "dev_inds"}
-DATA_CONFIG_OPTIONAL_ENTRIES = {"resample_rate", "n_max", "n_augment"}
+DATA_CONFIG_OPTIONAL_ENTRIES = {"resample_rate", "n_max", "n_augment",
+                                "n_shards", "record_format", "audio_cache",
+                                "audio_cache_mb", "frontend", "log_floor_db",
+                                "durations"}
 DATA_CONFIG_ALLOWED_ENTRIES = DATA_CONFIG_REQUIRED_ENTRIES.union(
     DATA_CONFIG_OPTIONAL_ENTRIES)
 
@@ -74,8 +129,14 @@ DATA_TYPE_ENTRIES = {"raw": {},
 for data_type, entries in DATA_TYPE_ENTRIES.items():
     DATA_CONFIG_ALLOWED_ENTRIES = DATA_CONFIG_ALLOWED_ENTRIES.union(entries)
 
-TO_INT_ENTRIES = {"resample_rate", "n_max", "n_augment", "window_size",
-                  "hop_length", "mel_freqs"}
+# how sequences are stored in the TFRecords files; the version is written to
+# each record so the parser can pick the right decoder
+RECORD_VERSIONS = {"float_list": 1, "float32": 2, "float16": 3}
+DEFAULT_RECORD_FORMAT = "float32"
+
+TO_INT_ENTRIES = {"resample_rate", "n_max", "n_augment", "n_shards",
+                  "audio_cache_mb", "window_size", "hop_length", "mel_freqs"}
+TO_FLOAT_ENTRIES = {"log_floor_db"}
 
 
 def read_data_config(config_path):
@@ -88,8 +149,10 @@ def read_data_config(config_path):
         datasets: Which datasets to use. Can be the name(s) of any number of
                   available datasets, separated by commas.
         data_type: One of "raw", "stft" or "mel".
-        dev_inds: Path to .npy array containing indices to put in the
-                  development set.
+        dev_inds: Where to keep track of the development set. The set is
+                  stored by file (see load_dev_set) in a json file next to
+                  this path; an existing .npy array of indices (the old
+                  format) is converted once.
     Maybe required depending on data_type:
         window_size: For STFT. Not needed if data_type is "raw".
         hop_length: For STFT. Not needed if data_type is "raw".
@@ -99,6 +162,28 @@ def read_data_config(config_path):
         n_max: If given, only process this many sequences per dataset.
         n_augment: If given, look for another TFRecord file with augmented 
                    data; if not found, create one.
+        n_shards: If given (and > 1), split each subset into this many
+                  TFRecord files and write a manifest listing them.
+        record_format: How to store sequences in new TFRecords files. One of
+                       "float_list" (old format, slow to parse), "float32"
+                       (raw bytes, default) or "float16" (raw bytes at half
+                       the size). Reading works for all formats regardless.
+        audio_cache: Folder for caching decoded/resampled audio (see
+                     audio_cache.AudioCache). No caching if not given.
+        audio_cache_mb: Size limit for the audio cache in megabytes.
+        frontend: Only for data_type "raw". Either "stft" or "mel"; the raw
+                  records are then transformed on the fly when reading them
+                  (see est_input.spectrogram), so one set of raw TFRecords
+                  can be used with different feature settings. Needs the
+                  same entries as the respective data_type.
+        log_floor_db: For stft/mel features (stored or from the frontend):
+                      Clip each sequence at this many dB below its maximum,
+                      e.g. 80. Avoids -inf for silence in the stored data,
+                      so threshold isn't needed anymore.
+        durations: Path to a duration table written by dataset_stats.py.
+                   If given, files that are too long are skipped without
+                   decoding them, and bucket boundaries can be found without
+                   going through the TFRecords.
 
     Entries can be in any order. Missing required entries will result in a
     crash, as will any superfluous (unexpected) entries.
@@ -141,47 +226,449 @@ def read_data_config(config_path):
                   "None!".format(o_entry))
             config_dict[o_entry] = None
 
+    if config_dict["frontend"] is not None:
+        if config_dict["data_type"] != "raw":
+            raise ValueError("A frontend can only be used with data_type "
+                             "raw.")
+        if config_dict["frontend"] not in ["stft", "mel"]:
+            raise ValueError("Invalid frontend {}. Valid are stft and "
+                             "mel.".format(config_dict["frontend"]))
+        for d_entry in DATA_TYPE_ENTRIES[config_dict["frontend"]]:
+            if d_entry not in found_entries:
+                raise ValueError("Entry {} expected for frontend {}, but not "
+                                 "found.".format(d_entry,
+                                                 config_dict["frontend"]))
+
+    if config_dict["record_format"] not in RECORD_VERSIONS and \
+            config_dict["record_format"] is not None:
+        raise ValueError("Invalid record_format {}. Valid are "
+                         "{}.".format(config_dict["record_format"],
+                                      sorted(RECORD_VERSIONS)))
+
     return config_dict
 
 
 def prepare_transform(config_dict):
-    """Prepare the appropriate function for a requested data transformation."""
+    """Prepare the appropriate function for a requested data transformation.
+
+    Returns:
+        None for raw data, else a features.FeatureExtractor. It can be called
+        on single sequences, transform batches via transform_batch and be sent
+        to worker processes.
+    """
     trans = config_dict["data_type"]
     if trans == "raw":
         return None
-    elif trans == "stft":
-        return lambda seq: np.log(np.abs(librosa.stft(
-            seq, n_fft=config_dict["window_size"],
-            hop_length=config_dict["hop_length"])))
-    elif trans == "mel":
-        return lambda seq: np.log(librosa.feature.melspectrogram(
-            y=seq, sr=config_dict["resample_rate"] or 44100,
-            n_fft=config_dict["window_size"],
-            hop_length=config_dict["hop_length"],
-            n_mels=config_dict["mel_freqs"]))
+    return FeatureExtractor(trans, config_dict["window_size"],
+                            config_dict["hop_length"],
+                            sr=config_dict["resample_rate"] or 44100,
+                            mel_freqs=config_dict.get("mel_freqs"),
+                            log_floor_db=config_dict.get("log_floor_db"))
+
+
+def prepare_frontend(config_dict):
+    """Feature extractor for the on-graph frontend, or None if not used.
+
+    The extractor itself is not applied to the stored data; it provides
+    window and mel filterbank for est_input.spectrogram and can transform
+    audio that doesn't come from the TFRecords (e.g. online augmentation or
+    inference) the same way.
+    """
+    if not config_dict.get("frontend"):
+        return None
+    return FeatureExtractor(config_dict["frontend"],
+                            config_dict["window_size"],
+                            config_dict["hop_length"],
+                            sr=config_dict["resample_rate"] or 44100,
+                            mel_freqs=config_dict.get("mel_freqs"),
+                            log_floor_db=config_dict.get("log_floor_db"))
+
+
+def stft_transform(seq, window_size, hop_length):
+    """Log magnitude of the STFT of a sequence.
+
+    Reference implementation with librosa; FeatureExtractor is used instead.
+    """
+    return np.log(np.abs(librosa.stft(seq, n_fft=window_size,
+                                      hop_length=hop_length,
+                                      pad_mode="reflect")))
+
+
+def mel_transform(seq, sr, window_size, hop_length, mel_freqs):
+    """Log mel spectrogram of a sequence.
+
+    Reference implementation with librosa; FeatureExtractor is used instead.
+    """
+    return np.log(librosa.feature.melspectrogram(
+        y=seq, sr=sr, n_fft=window_size, hop_length=hop_length,
+        n_mels=mel_freqs, pad_mode="reflect"))
+
+
+def tfrecord_path(tfr_path, subset, shard=0, n_shards=1):
+    """Path of a TFRecords file for a subset (train, dev, augment).
+
+    Parameters:
+        tfr_path: BASE path as given in the data config.
+        subset: Name of the subset.
+        shard: Index of the shard. Ignored if n_shards is 1.
+        n_shards: Total number of shards for this subset.
+
+    Returns:
+        Path to the file. For a single shard this is the "classic" unsharded
+        file name.
+    """
+    if n_shards and n_shards > 1:
+        return "{}_{}-{:05d}-of-{:05d}.tfrecords".format(
+            tfr_path, subset, shard, n_shards)
+    return tfr_path + "_" + subset + ".tfrecords"
+
+
+def manifest_path(tfr_path):
+    """Path of the manifest belonging to a TFRecords BASE path."""
+    return tfr_path + "_manifest.json"
+
+
+def read_manifest(tfr_path):
+    """Read what is there for all subsets, like write_manifest gets it.
+
+    Without a manifest, the unsharded files are listed (with their sizes from
+    the indices, if available; otherwise None).
+    """
+    if os.path.exists(manifest_path(tfr_path)):
+        with open(manifest_path(tfr_path)) as manifest_file:
+            manifest = json.load(manifest_file)
+        base_dir = os.path.dirname(tfr_path)
+        return {subset: {"files": [os.path.join(base_dir, path)
+                                   for path in entry["files"]],
+                         "n_examples": entry["n_examples"]}
+                for subset, entry in manifest.items()}
+    subsets = dict()
+    for subset in ["train", "dev", "augment"]:
+        paths = find_tfrecords(tfr_path, subset)
+        if paths:
+            index = read_index(paths)
+            subsets[subset] = {
+                "files": paths,
+                "n_examples": None if index is None else len(index)}
+    return subsets
+
+
+def write_manifest(tfr_path, subsets):
+    """Write a manifest listing the TFRecords files of all subsets.
+
+    Parameters:
+        tfr_path: BASE path as given in the data config.
+        subsets: Dict mapping subset names to dicts with entries "files" (list
+                 of paths) and "n_examples" (int).
+    """
+    base_dir = os.path.dirname(tfr_path)
+    manifest = {subset: {"files": [os.path.relpath(path, base_dir or ".")
+                                   for path in entry["files"]],
+                         "n_examples": entry["n_examples"]}
+                for subset, entry in subsets.items()}
+    with open(manifest_path(tfr_path), mode="w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+
+def skipped_path(tfr_path):
+    """Path of the list of files that were left out of the TFRecords."""
+    return tfr_path + "_skipped.json"
+
+
+def read_skipped(tfr_path):
+    """Set of file_key of all files that were left out of the TFRecords
+    (too long or unreadable); empty if there is no list."""
+    if not os.path.exists(skipped_path(tfr_path)):
+        return set()
+    with open(skipped_path(tfr_path)) as skipped_file:
+        return set(json.load(skipped_file))
+
+
+def write_skipped(tfr_path, keys):
+    """Store the file_key of files that were left out of the TFRecords."""
+    with open(skipped_path(tfr_path), mode="w") as skipped_file:
+        json.dump(sorted(keys), skipped_file, indent=0)
+
+
+def find_tfrecords(tfr_path, subset):
+    """Find all TFRecords files for a subset.
+
+    If a manifest exists, the files are taken from there. Otherwise we fall
+    back to the single unsharded file, if that exists.
+
+    Parameters:
+        tfr_path: BASE path as given in the data config.
+        subset: Name of the subset.
+
+    Returns:
+        List of paths; empty if nothing was found.
+    """
+    if os.path.exists(manifest_path(tfr_path)):
+        with open(manifest_path(tfr_path)) as manifest_file:
+            manifest = json.load(manifest_file)
+        if subset not in manifest:
+            return []
+        base_dir = os.path.dirname(tfr_path)
+        return [os.path.join(base_dir, path)
+                for path in manifest[subset]["files"]]
+
+    path = tfrecord_path(tfr_path, subset)
+    return [path] if os.path.exists(path) else []
+
+
+def index_path(tfr_file):
+    """Path of the index belonging to a single TFRecords file."""
+    return tfr_file + ".index.npy"
+
+
+def index_dtype(name_width):
+    """Numpy dtype of index tables.
+
+    Each row describes one record: its byte offset in the TFRecords file, the
+    example ID (see file_id; -1 for augmented examples), the source file,
+    label, shape of the stored sequence and duration of the source audio in
+    seconds.
+
+    Parameters:
+        name_width: Maximum length of the source file names.
+    """
+    return np.dtype([("offset", "<i8"), ("id", "<i8"),
+                     ("file", "<U{}".format(name_width)),
+                     ("label", "i1"), ("shape", "<i4", (2,)),
+                     ("duration", "<f4")])
+
+
+def write_index(tfr_file, rows):
+    """Store an index next to a TFRecords file.
+
+    Parameters:
+        tfr_file: Path to the TFRecords file.
+        rows: List of tuples offset, id, file, label, shape, duration. See
+              index_dtype.
+    """
+    name_width = max([len(row[2]) for row in rows], default=1)
+    np.save(index_path(tfr_file),
+            np.array(rows, dtype=index_dtype(name_width)))
+
+
+def read_index(tfr_files):
+    """Read the indices of a list of TFRecords files.
+
+    Parameters:
+        tfr_files: List of paths to TFRecords files, e.g. from find_tfrecords.
+
+    Returns:
+        One structured array with rows in the same order as the records when
+        reading the files one after the other. None if any index is missing.
+    """
+    indices = []
+    for tfr_file in tfr_files:
+        if not os.path.exists(index_path(tfr_file)):
+            return None
+        indices.append(np.load(index_path(tfr_file)))
+    if not indices:
+        return None
+    name_width = max(index.dtype["file"].itemsize // 4 for index in indices)
+    return np.concatenate([index.astype(index_dtype(name_width))
+                           for index in indices])
+
+
+def durations_dtype(name_width):
+    """Numpy dtype of duration tables: file, label, duration in seconds and
+    sampling rate of the audio (from the file header)."""
+    return np.dtype([("file", "<U{}".format(name_width)), ("label", "i1"),
+                     ("duration", "<f4"), ("sr", "<i4")])
+
+
+def write_durations(path, rows):
+    """Store a duration table.
+
+    Parameters:
+        path: Where to store it (.npy).
+        rows: List of tuples file, label, duration, sr.
+    """
+    name_width = max([len(row[0]) for row in rows], default=1)
+    np.save(path, np.array(rows, dtype=durations_dtype(name_width)))
+
+
+def read_durations(path):
+    """Read a duration table into a dict file key -> (duration, sr).
+
+    Keys are file_key of the file names, like in the indices, so lookups
+    don't depend on how the data directory is spelled.
+    """
+    table = np.load(path)
+    return {file_key(str(row["file"])): (float(row["duration"]),
+                                         int(row["sr"]))
+            for row in table}
 
 
-def make_dev_inds(data_list, prop_train, out_path):
-    """Create a numpy array with indices for a development set.
+def time_steps(duration, sr, config_dict):
+    """Number of time steps of a clip after the transformation of a config.
 
     Parameters:
-        data_list: List with data entries -- needed for its length.
-        prop_train: Float, desired proportional size of the training set.
-                    1-prop_train is the probability of each example being put
-                    into the dev set.
-        out_path: Path to store the array to.
+        duration: Length of the clip in seconds.
+        sr: Its original sampling rate.
+        config_dict: Data config.
     """
-    dev_inds = []
-    for ind, thing in enumerate(data_list):
-        if np.random.rand() >= prop_train:
-            dev_inds.append(ind)
-    np.save(out_path, np.array(dev_inds))
+    n_samples = int(duration * (config_dict["resample_rate"] or sr))
+    if config_dict["data_type"] == "raw" and not config_dict.get("frontend"):
+        return n_samples
+    return 1 + n_samples // config_dict["hop_length"]  # centered frames
+
+
+# proportion of files that are put into the dev set
+DEV_PROPORTION = 0.15
+
+
+def dev_set_path(dev_inds_path):
+    """Path of the json file with the dev set, see load_dev_set."""
+    return os.path.splitext(dev_inds_path)[0] + "_files.json"
+
+
+def hash_is_dev(key, prop_dev=DEV_PROPORTION):
+    """Decide by hash whether a file (see file_key) goes into the dev set."""
+    return int(hashlib.sha1(key.encode()).hexdigest()[:8], 16) < \
+        prop_dev * 16**8
+
+
+def load_dev_set(dev_inds_path, data_list):
+    """Find out which files of a data list belong to the dev set.
+
+    Membership is stored by file_key in a json file (see dev_set_path) with
+    all known files under "dev" and "train", so it doesn't depend on the
+    order of the data list. Files that are not known yet are assigned by
+    hash_is_dev and added, so files never change sides once assigned.
+    If only an old .npy array of indices into data_list exists at
+    dev_inds_path, it is converted; this is only correct if the data list
+    hasn't changed since the array was made.
+
+    Parameters:
+        dev_inds_path: dev_inds entry of the data config.
+        data_list: List of filename, label pairs.
+
+    Returns:
+        Set of keys of dev files and list of keys of files that were new.
+    """
+    path = dev_set_path(dev_inds_path)
+    keys = [file_key(filename) for filename, _ in data_list]
+    if os.path.exists(path):
+        with open(path) as dev_file:
+            known = json.load(dev_file)
+    elif os.path.exists(dev_inds_path):
+        print("Converting dev indices at {} to {}...".format(dev_inds_path,
+                                                            path))
+        dev_inds = set(int(ind) for ind in np.load(dev_inds_path))
+        known = {"dev": [key for ind, key in enumerate(keys)
+                         if ind in dev_inds],
+                 "train": [key for ind, key in enumerate(keys)
+                           if ind not in dev_inds]}
+    else:
+        known = {"dev": [], "train": []}
+
+    dev = set(known["dev"])
+    old = dev.union(known["train"])
+    new = [key for key in keys if key not in old]
+    for key in new:
+        known["dev" if hash_is_dev(key) else "train"].append(key)
+    if new or not os.path.exists(path):
+        with open(path + ".tmp", mode="w") as dev_file:
+            json.dump({subset: sorted(known[subset])
+                       for subset in ["dev", "train"]}, dev_file, indent=0)
+        os.replace(path + ".tmp", path)
+    return set(known["dev"]), new
+
+
+def dev_inds_of(data_list, dev_keys):
+    """Positions of dev files in a data list; see load_dev_set."""
+    return [ind for ind, (filename, _) in enumerate(data_list)
+            if file_key(filename) in dev_keys]
+
+
+def process_data_list(data_list, resample_rate, transform, n_workers=1,
+                      cache=None, max_seconds=20, durations=None,
+                      start_method=None):
+    """Load and transform all files in a data list.
+
+    Parameters:
+        data_list: List of filename, label pairs.
+        resample_rate: See make_tfrecords.make_tfrecords.
+        transform: See make_tfrecords.make_tfrecords.
+        n_workers: Number of processes to use. If 1, everything is done in
+                   this process.
+        cache: See make_tfrecords.make_tfrecords.
+        max_seconds: See process_file.
+        durations: See make_tfrecords.make_tfrecords.
+        start_method: multiprocessing start method for the workers. None
+                      uses the platform default (fork on Linux). Use
+                      "spawn" when calling this from a thread of a running
+                      TensorFlow process (e.g. a tf.data generator), where
+                      forking can deadlock.
+
+    Returns:
+        Iterator over the results of process_file, in the order of
+        data_list. Files that are known to be too long give None.
+    """
+    process = functools.partial(process_file, resample_rate=resample_rate,
+                                transform=transform, cache=cache,
+                                max_seconds=max_seconds)
+
+    def too_long(filename):
+        key = file_key(filename)
+        return bool(durations and max_seconds and key in durations and
+                    durations[key][0] > max_seconds)
+
+    skip = [too_long(filename) for filename, _ in data_list]
+    filenames = (filename for (filename, _), skipped in zip(data_list, skip)
+                 if not skipped)
+    if n_workers > 1:
+        context = multiprocessing.get_context(start_method)
+        with context.Pool(n_workers) as pool:
+            results = pool.imap(process, filenames, chunksize=8)
+            for skipped in skip:
+                yield None if skipped else next(results)
+    else:
+        results = map(process, filenames)
+        for skipped in skip:
+            yield None if skipped else next(results)
+
+
+def process_file(filename, resample_rate, transform, cache=None,
+                 max_seconds=20):
+    """Load and transform a single file.
+
+    Parameters:
+        filename: Path to the file.
+        resample_rate: See make_tfrecords.make_tfrecords.
+        transform: See make_tfrecords.make_tfrecords.
+        cache: See make_tfrecords.make_tfrecords.
+        max_seconds: Longer sequences are skipped. None disables this.
+
+    Returns:
+        The transformed sequence (always 2D) and the duration of the audio in
+        seconds, or None if the sequence is too long or the file could not be
+        processed.
+    """
+    try:
+        seq, sr = load_audio(filename, sr=resample_rate, cache=cache)
+        duration = len(seq) / sr
+        if max_seconds and duration > max_seconds:
+            return None
+        if transform:
+            return transform(seq), duration
+        else:  # raw: Add fake channel axis
+            return seq[None, :], duration
+    except Exception as err:  # one bad file should not kill the whole run
+        print("Could not process {}, skipping it: {}".format(filename, err))
+        return None
 
 
 def maybe_to_int(key, val):
-    """Converts data config entries to int if needed."""
+    """Converts data config entries to int (or float) if needed."""
     if key in TO_INT_ENTRIES:
         return int(val)
+    if key in TO_FLOAT_ENTRIES:
+        return float(val)
     return val
 
 
@@ -1,72 +1,183 @@
 import argparse
+import multiprocessing
 import os
+import sys
 
-import librosa
+import numpy as np
+import soundfile
 
-from data_utils import make_labeled_iterator, make_unlabeled_iterator
+from data_utils import find_tfrecords, make_labeled_data_list, \
+    make_unlabeled_data_list, read_index, write_durations
 
 
-def dataset_stats(iterator, filter_length):
-    total_seqs = 0
-    total_pos = 0
-    total_length = 0
-    min_length = float("inf")
-    max_length = 0
+# the original filter settings, in samples at the native rate
+MAX_FRAMES = 600000
+MIN_FRAMES = 120000
+
+
+def file_info(filename):
+    """Number of frames and sampling rate of an audio file, from its header.
+
+    Returns:
+        Tuple frames, sr; None if the file can't be read.
+    """
+    try:
+        info = soundfile.info(filename)
+        return info.frames, info.samplerate
+    except Exception as err:
+        print("Could not read {}, skipping it: {}".format(filename, err))
+        return None
+
+
+def read_file_infos(data_list, n_workers=1):
+    """file_info for all files in a data list, in order."""
+    filenames = [filename for filename, _ in data_list]
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers) as pool:
+            return pool.map(file_info, filenames, chunksize=64)
+    return [file_info(filename) for filename in filenames]
+
+
+def dataset_stats(data_list, infos, filter_length, n_bins=20):
+    """Print stats and a length histogram for a data list.
+
+    Parameters:
+        data_list: List of filename, label pairs.
+        infos: file_info for each entry of data_list.
+        filter_length: If set, leave out files that are too long or short
+                       (see MAX_FRAMES, MIN_FRAMES).
+        n_bins: Number of histogram bins.
+
+    Returns:
+        List of tuples file, label, duration, sr for all files that were
+        counted.
+    """
+    rows = []
     too_short = 0
     too_long = 0
-
-    for filename, label in iterator:
-        seq, _ = librosa.load(filename, sr=None)
-        l = len(seq)
-        if l < min_length:
-            min_length = l
-        if l > max_length:
-            max_length = l
+    for (filename, label), info in zip(data_list, infos):
+        if info is None:
+            continue
+        frames, sr = info
         if filter_length:
-            if l > 600000:
+            if frames > MAX_FRAMES:
                 too_long += 1
-                print("Skipping {} with length {}".format(filename, l))
+                print("Skipping {} with length {}".format(filename, frames))
                 continue
-            if l < 120000:
+            if frames < MIN_FRAMES:
                 too_short += 1
-                print("Skipping {} with length {}".format(filename, l))
+                print("Skipping {} with length {}".format(filename, frames))
                 continue
+        rows.append((filename, label, frames / sr, sr))
+    if not rows:
+        print("No files found.")
+        return rows
 
-        total_pos += label
-        total_seqs += 1
-        total_length += len(seq) / 44100
-
-    print("Total: {} Positive: {} Average: {}".format(total_seqs, total_pos,
-                                                      total_pos/total_seqs))
+    labels = np.array([row[1] for row in rows])
+    durations = np.array([row[2] for row in rows])
+    rates = sorted(set(row[3] for row in rows))
+    total_length = durations.sum()
+    print("Total: {} Positive: {} Average: {}".format(
+        len(rows), labels.sum(), labels.mean()))
     print("Total length: Seconds: {} Minutes {}: Hours: {}".format(
         total_length, total_length/60, total_length/3600))
-    print("Longest sequence: {} Shortest: {}".format(max_length, min_length))
+    print("Longest sequence: {:.2f}s Shortest: {:.2f}s".format(
+        durations.max(), durations.min()))
+    print("Sampling rates: {}".format(rates))
     print("Skipped {} too long sequences and {} too short ones".format(
         too_long, too_short))
 
+    counts, edges = np.histogram(durations, bins=n_bins)
+    scale = 50 / counts.max()
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        print("{:7.2f}s - {:7.2f}s {:7d} {}".format(
+            low, high, count, "#" * int(np.ceil(count * scale))))
+    return rows
+
+
+def index_stats(tfr_path):
+    """Print stats for existing TFRecords from their indices, without audio.
+
+    Parameters:
+        tfr_path: BASE path to the TFRecords files, as in the data config.
+    """
+    for subset in ["train", "dev", "augment"]:
+        index = read_index(find_tfrecords(tfr_path, subset))
+        if index is None:
+            print("\nNo index found for subset {}.".format(subset))
+            continue
+        durations = index["duration"].astype(np.float64)
+        lengths = index["shape"][:, -1]
+        print("\nStats for {} set...".format(subset))
+        print("Total: {} Positive: {} Average: {}".format(
+            len(index), index["label"].sum(), index["label"].mean()))
+        print("Total length: Seconds: {} Minutes {}: Hours: {}".format(
+            np.nansum(durations), np.nansum(durations)/60,
+            np.nansum(durations)/3600))
+        print("Longest sequence: {} Shortest: {} (time steps)".format(
+            lengths.max(), lengths.min()))
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        description="Print stats of the datasets. Only the file headers are "
+                    "read, not the audio.")
     parser.add_argument("data_path",
                         help="Path to where the data is.")
-    parser.add_argument("-f", "--filter", action="store_true")
-    parser.add_argument("-t", "--transform", default="raw",
-                        help="How to transform the input sequences. 'raw' "
-                             "(default), 'stft' or 'mel'.")
+    parser.add_argument("-f", "--filter", action="store_true",
+                        help="Leave out files that are too long or too "
+                             "short.")
+    parser.add_argument("-i", "--index",
+                        help="Instead of going through the audio, print stats "
+                             "for the TFRecords at this BASE path from their "
+                             "indices.")
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes for reading file headers. "
+                             "Default: 1.")
+    parser.add_argument("-b", "--bins",
+                        type=int,
+                        default=20,
+                        help="Number of bins for the length histograms. "
+                             "Default: 20.")
+    parser.add_argument("-o", "--out",
+                        help="Write a duration table (.npy) for all labeled "
+                             "files here. Use it as durations in a data "
+                             "config.")
     args = parser.parse_args()
 
-    print("\nStats for both training sets...")
-    ITER = make_labeled_iterator(args.data_path, ["freefield", "warblr"])
-    dataset_stats(ITER, filter_length=args.filter)
+    if args.index:
+        index_stats(args.index)
+        sys.exit()
 
-    print("\nStats for freefield training set...")
-    ITER = make_labeled_iterator(args.data_path, ["freefield"])
-    dataset_stats(ITER, filter_length=args.filter)
+    DATA_LIST = []
+    INFOS = []
+    for dataset in ["freefield", "warblr"]:
+        print("\nStats for {} training set...".format(dataset))
+        SET_LIST = make_labeled_data_list(args.data_path, [dataset])
+        SET_INFOS = read_file_infos(SET_LIST, args.workers)
+        dataset_stats(SET_LIST, SET_INFOS, filter_length=args.filter,
+                      n_bins=args.bins)
+        DATA_LIST += SET_LIST
+        INFOS += SET_INFOS
+
+    print("\nStats for both training sets...")
+    dataset_stats(DATA_LIST, INFOS, filter_length=args.filter,
+                  n_bins=args.bins)
 
-    print("\nStats for warblr training set...")
-    ITER = make_labeled_iterator(args.data_path, ["warblr"])
-    dataset_stats(ITER, filter_length=args.filter)
+    if args.out:
+        # all files, regardless of filtering
+        ROWS = [
+            (filename, label, info[0] / info[1], info[1])
+            for (filename, label), info in zip(DATA_LIST, INFOS)
+            if info is not None]
+        write_durations(args.out, ROWS)
+        print("\nWrote durations of {} files to {}.".format(len(ROWS),
+                                                           args.out))
 
     print("\nStats for test set...")
-    ITER = make_unlabeled_iterator(os.path.join(args.data_path, "testset"))
-    dataset_stats(ITER, filter_length=False)
+    TEST_LIST = make_unlabeled_data_list(os.path.join(args.data_path,
+                                                      "testset"))
+    dataset_stats(TEST_LIST, read_file_infos(TEST_LIST, args.workers),
+                  filter_length=False, n_bins=args.bins)
@@ -0,0 +1,352 @@
+import functools
+import math
+import time
+
+import librosa
+import numpy as np
+import soundfile
+import tensorflow as tf
+
+from est_input import apply_threshold
+from est_models import score_window_frames
+from features import FeatureStream
+
+
+# file index and window index are packed into one example ID
+WINDOW_BITS = 32
+
+
+def stream_windows(filename, geometry, extractor=None, resample_rate=None,
+                   block_seconds=60.):
+    """Cut a (long) audio file into overlapping windows, block by block.
+
+    Only about one block of audio and one window of features are kept in
+    memory at a time, however long the file is. Features are computed once
+    per frame (not per window), so overlap doesn't cost extra. Since windows
+    are cut from the features of the whole recording, their first and last
+    frames can differ slightly from those of a clip of the same audio, which
+    would be padded at its edges. Also, the log floor (if any) is relative to
+    each window. Resampling is done block by block, but with context from
+    the neighbouring blocks (see resampled_blocks), so block boundaries
+    don't show in the features.
+
+    Parameters:
+        filename: Path to the audio file.
+        geometry: Function that takes the sampling rate and returns window
+                  length and hop in frames, and seconds per frame; see
+                  window_geometry and chunk_geometry.
+        extractor: features.FeatureExtractor; None for raw data.
+        resample_rate: If given, the audio is resampled to this rate (block
+                       by block).
+        block_seconds: How much audio to read at once.
+
+    Returns:
+        Generator over start time (in seconds) and features (freqs x time)
+        of each window. The last window can be shorter; a file shorter than
+        a window gives one short window.
+    """
+    sr = resample_rate or soundfile.info(filename).samplerate
+    window, hop, frame_seconds = geometry(sr)
+    stream = FeatureStream(extractor) if extractor else None
+
+    frames = np.zeros((0, extractor.n_features if extractor else 1),
+                      dtype=np.float32)
+    n_windows = 0
+
+    def finish(part):
+        if extractor:
+            return extractor.log(part).astype(np.float32)
+        return part.T
+
+    for block in resampled_blocks(filename, sr, block_seconds):
+        new = stream.push(block) if stream else block[:, None]
+        frames = np.concatenate([frames, new])
+        while len(frames) >= window:
+            yield n_windows * hop * frame_seconds, finish(frames[:window])
+            n_windows += 1
+            frames = frames[hop:]
+
+    # the start of frames has been in the last window already
+    covered = max(window - hop, 0) if n_windows else 0
+    if len(frames) > covered:
+        yield n_windows * hop * frame_seconds, finish(frames)
+
+
+def resampled_blocks(filename, sr, block_seconds=60., context_seconds=0.1):
+    """Read an audio file block by block, as mono at sampling rate sr.
+
+    Resampling each block on its own would give filter transients at every
+    block boundary. Instead, each block is read and resampled with
+    context_seconds of audio on either side, which is cut off again after
+    resampling. Blocks start on multiples of the smallest native step that
+    maps to a whole number of output samples, so the pieces fit together
+    without gaps or phase shifts. Concatenated, the blocks are (up to
+    filter tails longer than the context) the same as resampling the whole
+    file at once.
+
+    Parameters:
+        filename: Path to the audio file.
+        sr: Sampling rate to return.
+        block_seconds: Approximate length of the blocks.
+        context_seconds: Extra audio to resample with on either side.
+
+    Returns:
+        Generator over 1D float32 arrays.
+    """
+    info = soundfile.info(filename)
+    native = info.samplerate
+    if sr == native:
+        for block in soundfile.blocks(filename, dtype="float32",
+                                      blocksize=int(block_seconds * native),
+                                      always_2d=True):
+            yield block.mean(axis=1)
+        return
+
+    step = native // math.gcd(native, sr)
+    context = int(math.ceil(context_seconds * native / step)) * step
+    block_size = max(1, int(block_seconds * native) // step) * step
+    for start in range(0, info.frames, block_size):
+        stop = min(start + block_size, info.frames)
+        low = max(start - context, 0)
+        block, _ = soundfile.read(filename, start=low,
+                                  stop=min(stop + context, info.frames),
+                                  dtype="float32", always_2d=True)
+        resampled = librosa.resample(block.mean(axis=1), orig_sr=native,
+                                     target_sr=sr)
+        # start and low are on the step grid, so these are exact
+        first = (start - low) * sr // native
+        length = (-(-stop * sr // native) if stop == info.frames else
+                  stop * sr // native) - start * sr // native
+        yield resampled[first:first + length].astype(np.float32)
+
+
+def window_geometry(sr, window_seconds, hop_seconds, extractor=None):
+    """Window length and hop in frames, and seconds per frame.
+
+    Parameters:
+        sr: Sampling rate the features are computed at.
+        window_seconds: Length of the windows.
+        hop_seconds: Time between the starts of consecutive windows.
+        extractor: See stream_windows.
+    """
+    step = extractor.hop_length if extractor else 1
+    return (int(round(window_seconds * sr / step)),
+            int(round(hop_seconds * sr / step)), step / sr)
+
+
+def chunk_geometry(sr, window_seconds, hop_seconds, extractor, total_stride,
+                   windows_per_chunk):
+    """Like window_geometry, but for chunks that hold several windows.
+
+    Chunk c holds the windows c * windows_per_chunk up to (c + 1) *
+    windows_per_chunk - 1, so all windows are scored exactly once. Window
+    size and hop are rounded to multiples of the model's total stride (see
+    est_models.window_logits).
+
+    Parameters:
+        total_stride: Total stride of the model.
+        windows_per_chunk: How many windows to score per chunk.
+        Others: See window_geometry.
+    """
+    window, hop, frame_seconds = window_geometry(sr, window_seconds,
+                                                 hop_seconds, extractor)
+    window, hop = score_window_frames(window, hop, total_stride)
+    return ((window + (windows_per_chunk - 1) * hop) * total_stride,
+            windows_per_chunk * hop * total_stride, frame_seconds)
+
+
+def detect_input_fn(filenames, batch_size, freqs, threshold, geometry,
+                    extractor=None, resample_rate=None):
+    """Builds an input function over windows of long audio files.
+
+    Parameters:
+        filenames: List of paths to audio files.
+        batch_size, freqs, threshold: See est_input.input_fn.
+        geometry, extractor, resample_rate: See stream_windows.
+
+    Returns:
+        get_next op of iterator. Features are a dict with the windows under
+        "seq" and IDs under "id", see window_id. Labels are always -1.
+        Files that can't be read are skipped.
+    """
+    def gen():
+        for file_ind, filename in enumerate(filenames):
+            try:
+                for window_ind, (_, seq) in enumerate(stream_windows(
+                        filename, geometry, extractor, resample_rate)):
+                    yield ({"seq": seq[None], "id": window_id(file_ind,
+                                                              window_ind)},
+                           np.array([-1], dtype=np.int32))
+            except Exception as err:  # one bad file should not stop the rest
+                print("Could not process {}, skipping it: {}".format(
+                    filename, err))
+
+    data = tf.data.Dataset.from_generator(
+        gen, ({"seq": tf.float32, "id": tf.int64}, tf.int32),
+        ({"seq": tf.TensorShape([1, freqs, None]), "id": tf.TensorShape([])},
+         tf.TensorShape([1])))
+    if threshold:
+        data = data.map(lambda features, label: (
+            {"seq": apply_threshold(features["seq"]), "id": features["id"]},
+            label))
+    data = data.padded_batch(
+        batch_size, ({"seq": (1, freqs, -1), "id": ()}, (1,)))
+    data = data.prefetch(4)
+    iterator = data.make_one_shot_iterator()
+    return iterator.get_next()
+
+
+def window_id(file_ind, window_ind):
+    """Example ID of a window; see split_window_id."""
+    return (file_ind << WINDOW_BITS) + window_ind
+
+
+def split_window_id(example_id):
+    """File index and window index of a window's example ID."""
+    return example_id >> WINDOW_BITS, example_id & (2**WINDOW_BITS - 1)
+
+
+class SegmentWriter:
+    """Merges detections of consecutive windows into segments.
+
+    Windows have to come in order (per file). A segment is written as soon as
+    a window without detection (or a new file) ends it.
+    """
+
+    def __init__(self, out, detect_threshold):
+        """
+        Parameters:
+            out: Open file to write csv lines file,start,end,probability to.
+                 Probability is the maximum over the segment.
+            detect_threshold: Probability above which a window counts as
+                              bird presence.
+        """
+        self.out = out
+        self.detect_threshold = detect_threshold
+        self.current = None  # file, start, end, max. probability
+        self.n_segments = 0
+
+    def add(self, filename, start, end, probability):
+        if probability < self.detect_threshold:
+            self.flush()
+            return
+        if self.current and self.current[0] == filename and \
+                start <= self.current[2]:
+            self.current = (filename, self.current[1], max(end,
+                                                           self.current[2]),
+                            max(probability, self.current[3]))
+        else:
+            self.flush()
+            self.current = (filename, start, end, probability)
+
+    def flush(self):
+        if self.current:
+            self.out.write("{},{:.2f},{:.2f},{}\n".format(*self.current))
+            self.out.flush()
+            self.n_segments += 1
+            self.current = None
+
+
+def run_detection(estimator, filenames, out_file, batch_size, freqs,
+                  threshold, window_seconds, hop_seconds, detect_threshold,
+                  extractor=None, resample_rate=None, total_stride=None,
+                  windows_per_chunk=32):
+    """Find segments with birds in long recordings.
+
+    Parameters:
+        estimator: The trained tf.estimator.Estimator.
+        filenames: List of paths to audio files.
+        out_file: Path of the csv file to write segments to.
+        window_seconds, hop_seconds: See window_geometry.
+        detect_threshold: See SegmentWriter.
+        total_stride: If given, windows are scored windows_per_chunk at a
+                      time from one forward pass each (see chunk_geometry).
+                      The estimator needs score_window set in its params
+                      then (see est_models.model_fn), and resample_rate must
+                      be given.
+        windows_per_chunk: See chunk_geometry.
+        Others: See detect_input_fn.
+    """
+    if total_stride:
+        geometry = functools.partial(
+            chunk_geometry, window_seconds=window_seconds,
+            hop_seconds=hop_seconds, extractor=extractor,
+            total_stride=total_stride, windows_per_chunk=windows_per_chunk)
+        # window size and hop after rounding
+        window, hop, frame_seconds = window_geometry(
+            resample_rate, window_seconds, hop_seconds, extractor)
+        window, hop = [frames * total_stride * frame_seconds for frames in
+                       score_window_frames(window, hop, total_stride)]
+    else:
+        geometry = functools.partial(
+            window_geometry, window_seconds=window_seconds,
+            hop_seconds=hop_seconds, extractor=extractor)
+        window = window_seconds
+
+    durations = [None] * len(filenames)
+    chunk_hops = [None] * len(filenames)  # exact, after rounding to frames
+    for ind, filename in enumerate(filenames):
+        try:
+            info = soundfile.info(filename)
+        except Exception:  # will be reported when reading it
+            continue
+        durations[ind] = info.duration
+        _, chunk_hop, frame_seconds = geometry(resample_rate or
+                                               info.samplerate)
+        chunk_hops[ind] = chunk_hop * frame_seconds
+
+    def input_fn():
+        return detect_input_fn(filenames, batch_size, freqs, threshold,
+                               geometry, extractor, resample_rate)
+
+    predict_keys = ["id", "probabilities"]
+    if total_stride:
+        predict_keys.append("window_logits")
+    start_time = time.time()
+    audio_seconds = 0.
+    with open(out_file, mode="w") as out:
+        out.write("file,start,end,probability\n")
+        segments = SegmentWriter(out, detect_threshold)
+        last_file = None
+        for predictions in estimator.predict(input_fn=input_fn,
+                                             predict_keys=predict_keys):
+            file_ind, chunk_ind = split_window_id(int(predictions["id"]))
+            if file_ind != last_file:
+                if last_file is not None:
+                    audio_seconds += durations[last_file] or 0.
+                    report_speed(audio_seconds, time.time() - start_time)
+                last_file = file_ind
+            start = chunk_ind * chunk_hops[file_ind]
+            # actual length of the (possibly shorter, padded) last chunk
+            length = (durations[file_ind] or float("inf")) - start
+            if not total_stride:
+                segments.add(filenames[file_ind], start,
+                             start + min(window, length),
+                             float(predictions["probabilities"][0]))
+                continue
+            n_windows = 0 if length < window else min(
+                windows_per_chunk, int((length - window) / hop + 1e-6) + 1)
+            for ind in range(n_windows):
+                segments.add(filenames[file_ind], start + ind * hop,
+                             start + ind * hop + window, float(
+                                 sigmoid(predictions["window_logits"][ind])))
+            if not n_windows:  # too short for a window; score all of it
+                segments.add(filenames[file_ind], start,
+                             start + min(window, length),
+                             float(predictions["probabilities"][0]))
+        segments.flush()
+        if last_file is not None:
+            audio_seconds += durations[last_file] or 0.
+    report_speed(audio_seconds, time.time() - start_time)
+    print("Wrote {} segments to {}.".format(segments.n_segments, out_file))
+
+
+def sigmoid(logit):
+    return 1 / (1 + np.exp(-logit))
+
+
+def report_speed(audio_seconds, wall_seconds):
+    print("Processed {:.2f} hours of audio in {:.2f} hours ({:.1f} "
+          "audio-hours per hour).".format(
+              audio_seconds / 3600, wall_seconds / 3600,
+              audio_seconds / max(wall_seconds, 1e-9)))
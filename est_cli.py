@@ -5,10 +5,18 @@ from est_main import run_birds
 
 parser = argparse.ArgumentParser()
 parser.add_argument("mode",
-                    choices=["train", "predict", "eval", "return"],
-                    help="What to do. 'train', 'predict', 'eval' or "
-                         "'return' The latter simply returns the estimator "
-                         "object.")
+                    choices=["train", "predict", "eval", "infer", "detect",
+                             "export", "return"],
+                    help="What to do. 'train', 'predict', 'eval', 'infer', "
+                         "'detect', 'export' or 'return' The latter simply "
+                         "returns the estimator object. 'infer' scores all "
+                         "files in --wav_dir and writes the results to "
+                         "--out_file. 'detect' scans (long) recordings in "
+                         "--wav_dir with a sliding window and writes "
+                         "segments with birds to --out_file. "
+                         "'export' writes the latest checkpoint as a frozen "
+                         "graph to model_dir/export, to be used with "
+                         "serve.py.")
 parser.add_argument("data_config",
                     help="Path to data config file. See code for details.")
 parser.add_argument("model_config",
@@ -22,6 +30,12 @@ parser.add_argument("-a", "--act",
                     help="Which activation function to use. "
                          "Can be one of 'relu' (default),"
                          "or 'elu'.")
+parser.add_argument("--activations",
+                    action="store_true",
+                    help="Only for predict mode: Also return the input and all"
+                         " layer activations for each example. This is much "
+                         "slower and needs a lot more memory than returning "
+                         "only the scores.")
 parser.add_argument("-b", "--batchnorm",
                     action="store_true",
                     help="Set to use batch normalization.")
@@ -38,6 +52,23 @@ parser.add_argument("-B", "--batch_size",
                     type=int,
                     default=64,
                     help="Batch size. Default: 64.")
+parser.add_argument("--buckets",
+                    type=int,
+                    default=0,
+                    help="Batch training examples of similar length together "
+                         "using this many buckets. Boundaries are chosen so "
+                         "that buckets are about equally full. Default: 0 "
+                         "(no bucketing).")
+parser.add_argument("--bucket_boundaries",
+                    nargs="+",
+                    type=int,
+                    help="Explicit bucket boundaries (in time steps) to use "
+                         "instead of deriving them. Implies bucketing.")
+parser.add_argument("--bucket_batch_sizes",
+                    nargs="+",
+                    type=int,
+                    help="Batch size per bucket (one more than there are "
+                         "boundaries). Default: batch size for all buckets.")
 parser.add_argument("-C", "--clipping",
                     type=float,
                     default=0.0,
@@ -53,10 +84,22 @@ parser.add_argument("-F", "--data_format",
                     help="Data format. Either 'channels_first' "
                          "(default, recommended for GPU) "
                          "or 'channels_last', recommended for CPU.")
+parser.add_argument("--eval_cache",
+                    help="For eval and predict mode: Cache the parsed and "
+                         "padded dev batches instead of reading the "
+                         "TFRecords every time. Either 'memory' (kept per "
+                         "process) or a folder for cache files that are "
+                         "reused across runs. Default: no caching.")
 parser.add_argument("-G", "--augment",
                     action="store_true",
                     help="Use augmented training data. Will lead to a crash "
                          "if no such data is available!")
+parser.add_argument("-g", "--online_augment",
+                    action="store_true",
+                    help="Create augmented training data on the fly instead "
+                         "of reading it from disk. Needs n_augment in the "
+                         "data config and loads all training audio into "
+                         "memory.")
 parser.add_argument("-L", "--label_smoothing",
                     type=float,
                     default=0.0,
@@ -81,6 +124,13 @@ parser.add_argument("-S", "--steps",
 parser.add_argument("-T", "--threshold",
                     action="store_true",
                     help="Threshold input: Remove anything 80db below max.")
+parser.add_argument("-W", "--crop_width",
+                    type=int,
+                    default=0,
+                    help="Train on random crops of this many time steps "
+                         "(shorter sequences are padded). Evaluation and "
+                         "prediction still use full sequences. Default: 0 "
+                         "(no cropping).")
 parser.add_argument("-U", "--use_avg",
                     action="store_true",
                     help="Use average pooling over time at the end instead of "
@@ -96,16 +146,86 @@ parser.add_argument("-V", "--vis",
                          "100). Default: 100. Setting this to 0 will only plot"
                          " curves for loss and steps per second, every 100 "
                          "steps. This may result in faster execution.")
-args = parser.parse_args()
+parser.add_argument("--profile_window",
+                    type=int,
+                    default=1,
+                    help="Number of consecutive steps to profile each time "
+                         "profiling is due (see vis). Only these steps are "
+                         "traced. Default: 1.")
+parser.add_argument("--timeline",
+                    action="store_true",
+                    help="Also write Chrome traces of the profiled steps "
+                         "(open in chrome://tracing) and their time per op "
+                         "type as JSON to model_dir/timeline.")
+parser.add_argument("--input_stats",
+                    action="store_true",
+                    help="Only for train mode: Measure how much of each step "
+                         "is spent waiting for input data and how often the "
+                         "next batch was already prefetched. Written as "
+                         "summaries (input_stall/...) and logged every vis "
+                         "steps (100 if vis is 0).")
+
+parser.add_argument("--wav_dir",
+                    help="Only for infer and detect mode: Directory with "
+                         "audio files to score.")
+parser.add_argument("--out_file",
+                    help="Only for infer and detect mode: CSV file to write "
+                         "file names and probabilities (or segments) to.")
+parser.add_argument("--window_seconds",
+                    type=float,
+                    default=10.,
+                    help="Only for detect mode: Length of the windows that "
+                         "are scored. Default: 10.")
+parser.add_argument("--hop_seconds",
+                    type=float,
+                    default=5.,
+                    help="Only for detect mode: Time between the starts of "
+                         "consecutive windows. Default: 5.")
+parser.add_argument("--frame_scores",
+                    action="store_true",
+                    help="Only for detect mode: Run the model once over "
+                         "long chunks and score all windows in them from the "
+                         "per-time-step features, instead of running it on "
+                         "every window. Much faster with overlapping "
+                         "windows; scores differ slightly at window edges.")
+parser.add_argument("--detect_threshold",
+                    type=float,
+                    default=0.5,
+                    help="Only for detect mode: Probability above which a "
+                         "window counts as containing birds. Default: 0.5.")
+parser.add_argument("--workers",
+                    type=int,
+                    default=1,
+                    help="Number of processes. In infer mode, these decode "
+                         "and transform audio. In eval mode, checkpoints are "
+                         "spread over them. Default: 1.")
+
 
+# spawned worker processes (infer, eval) import this module again, so only
+# run when started as a script
+if __name__ == "__main__":
+    args = parser.parse_args()
 
-out = run_birds(mode=args.mode, data_config=args.data_config,
-                model_config=args.model_config, model_dir=args.model_dir,
-                act=args.act, batchnorm=args.batchnorm,
-                adam_params=args.adam_params, augment=args.augment,
-                batch_size=args.batch_size, clipping=args.clipping,
-                data_format=args.data_format,
-                label_smoothing=args.label_smoothing, normalize=args.normalize,
-                onedim=args.onedim, reg=args.reg, renorm=args.renorm,
-                steps=args.steps, threshold=args.threshold,
-                use_avg=args.use_avg, vis=args.vis)
+    out = run_birds(mode=args.mode, data_config=args.data_config,
+                    model_config=args.model_config, model_dir=args.model_dir,
+                    act=args.act, activations=args.activations,
+                    batchnorm=args.batchnorm,
+                    adam_params=args.adam_params, augment=args.augment,
+                    batch_size=args.batch_size,
+                    bucket_batch_sizes=args.bucket_batch_sizes,
+                    bucket_boundaries=args.bucket_boundaries,
+                    clipping=args.clipping, crop_width=args.crop_width,
+                    data_format=args.data_format,
+                    detect_threshold=args.detect_threshold,
+                    eval_cache=args.eval_cache, frame_scores=args.frame_scores,
+                    hop_seconds=args.hop_seconds, input_stats=args.input_stats,
+                    label_smoothing=args.label_smoothing,
+                    n_buckets=args.buckets,
+                    normalize=args.normalize,
+                    onedim=args.onedim, online_augment=args.online_augment,
+                    out_file=args.out_file, profile_window=args.profile_window,
+                    reg=args.reg, renorm=args.renorm,
+                    steps=args.steps, threshold=args.threshold,
+                    timeline=args.timeline,
+                    use_avg=args.use_avg, vis=args.vis, wav_dir=args.wav_dir,
+                    window_seconds=args.window_seconds, workers=args.workers)
@@ -1,27 +1,104 @@
+import hashlib
 import os
 
+import numpy as np
 import tensorflow as tf
 
+from data_utils import RECORD_VERSIONS, find_tfrecords, \
+    process_data_list, read_index
 
-def input_fn(data_path, subset, batch_size, freqs, augment, threshold):
+
+def input_fn(data_path, subset, batch_size, freqs, augment, threshold,
+             **kwargs):
     """Builds an input function for tf.estimator.
+
+    Parameters:
+        All are passed on to make_dataset; see there.
+
+    Returns:
+        get_next op of iterator.
+    """
+    data = make_dataset(data_path, subset, batch_size, freqs, augment,
+                        threshold, **kwargs)
+    iterator = data.make_one_shot_iterator()
+    return iterator.get_next()
+
+
+def make_dataset(data_path, subset, batch_size, freqs, augment, threshold,
+                 augment_pool=None, n_augment=0, bucket_boundaries=None,
+                 bucket_batch_sizes=None, crop_width=0, with_ids=False,
+                 batch_cache=None, frontend=None):
+    """Builds the dataset of batches behind input_fn.
     
+    If the data is sharded (see data_utils.read_data_config), the shards are
+    found via the manifest and read in parallel. In that case, training data
+    is shuffled at shard level first, so a much smaller shuffle buffer is used.
+
     Parameters:
-        data_path: Base path to tfrecords data file.
+        data_path: Base path to tfrecords data file(s).
         subset: One of "train" or "dev".
         batch_size: Duh.
         freqs: Size of the frequency axis we can expect.
         augment: Whether to use augmentation. Only used in train mode.
         threshold: If set, threshold at 80db below maximum for each sequence.
+        augment_pool: Optional augment.AugmentationPool. If given (and
+                      augment is set), augmented examples are created on the
+                      fly from this pool instead of read from disk.
+        n_augment: Number of augmented examples "per epoch" when using
+                   augment_pool. Controls the proportion of augmented data,
+                   which is the same as it would be with stored data.
+        bucket_boundaries: Optional list of ints. If given, training examples
+                           are batched together with others of similar length
+                           (number of time steps) to reduce padding. See
+                           bucket_boundaries_from_records.
+        bucket_batch_sizes: Optional list of batch sizes, one more than there
+                            are boundaries. Default is batch_size for each
+                            bucket.
+        crop_width: If set, each training example is cut to a random window
+                    of this many time steps (shorter ones are randomly
+                    padded). Other subsets always use the full sequences.
+        with_ids: If set, features are a dict with the sequences under "seq"
+                  and the example IDs (see data_utils.file_id) under "id".
+                  Not supported together with augmentation, bucketing or
+                  cropping, which are meant for training.
+        batch_cache: Only for subsets other than train. If "memory", the
+                     parsed and padded batches are kept in memory after the
+                     first time this is called in a process, and replayed
+                     from there later. Otherwise, can be a folder for a
+                     tf.data cache file which is written on the first full
+                     pass and read afterwards. Either way, the cache is keyed
+                     by the TFRecords files and all settings that influence
+                     the batches.
+        frontend: Optional features.FeatureExtractor (see
+                  data_utils.prepare_frontend) for raw records. If given,
+                  the waveforms are turned into spectrograms right after
+                  parsing, so everything after (cropping, bucketing, freqs)
+                  refers to spectrogram frames.
     
     Returns:
-        get_next op of iterator.
+        tf.data.Dataset of batches. Training data repeats forever.
     """
-    paths = [data_path + "_" + subset + ".tfrecords"]
-    if subset == "train" and augment:
-        aug_path = data_path + "_augment.tfrecords"
-        if os.path.exists(aug_path):
-            paths.append(aug_path)
+    if bucket_boundaries and bucket_batch_sizes and \
+            len(bucket_batch_sizes) != len(bucket_boundaries) + 1:
+        raise ValueError("Need one more bucket batch size than bucket "
+                         "boundaries; got {} batch sizes for {} "
+                         "boundaries.".format(len(bucket_batch_sizes),
+                                              len(bucket_boundaries)))
+    paths = find_tfrecords(data_path, subset)
+    if not paths:
+        raise ValueError("No TFRecords files found for subset {} at "
+                         "{}.".format(subset, data_path))
+    if subset != "train" and batch_cache:
+        key = batch_cache_key(paths, freqs, batch_size, threshold, with_ids,
+                              frontend)
+        if batch_cache == "memory":
+            return replay_batches(key, lambda: make_dataset(
+                data_path, subset, batch_size, freqs, augment, threshold,
+                with_ids=with_ids, frontend=frontend))
+    if subset == "train" and augment and augment_pool is None:
+        aug_paths = find_tfrecords(data_path, "augment")
+        if aug_paths:
+            paths += aug_paths
         else:
             raise ValueError("Augmented data requested but not found.")
         # bonus
@@ -29,43 +106,315 @@ def input_fn(data_path, subset, batch_size, freqs, augment, threshold):
         if os.path.exists(aug_path2):
             paths.append(aug_path2)
 
-    data = tf.data.TFRecordDataset(paths)
+    if subset == "train" and len(paths) > 1:
+        files = tf.data.Dataset.from_tensor_slices(paths).shuffle(len(paths))
+        data = files.apply(tf.contrib.data.parallel_interleave(
+            tf.data.TFRecordDataset, cycle_length=min(len(paths), 16),
+            sloppy=True))
+    else:  # keep the order fixed for evaluation/prediction
+        data = tf.data.TFRecordDataset(paths)
 
     if subset == "train":
-        data = data.shuffle(buffer_size=2**18)
-    data = data.map(lambda x: parse_example(x, threshold))
-    data = data.padded_batch(batch_size, ((1, freqs, -1), (1,)))
+        # the more files we interleave, the better mixed the data already is
+        data = data.shuffle(buffer_size=max(2**18 // len(paths), 2**12))
+    data = data.map(lambda x: parse_example(x, threshold, with_ids, frontend))
+    if subset == "train" and augment and augment_pool is not None:
+        aug_data = augment_dataset(augment_pool, freqs, threshold)
+        aug_weight = n_augment / (n_augment + len(augment_pool))
+        data = tf.contrib.data.sample_from_datasets(
+            [data.repeat(), aug_data], weights=[1 - aug_weight, aug_weight])
+    if subset == "train" and crop_width:
+        data = data.map(lambda seq, label: (random_crop(seq, crop_width),
+                                            label))
+    if subset == "train" and bucket_boundaries:
+        data = data.apply(tf.contrib.data.bucket_by_sequence_length(
+            lambda seq, label: tf.shape(seq)[-1], bucket_boundaries,
+            bucket_batch_sizes or [batch_size] * (len(bucket_boundaries) + 1),
+            padded_shapes=((1, freqs, -1), (1,))))
+    elif with_ids:
+        data = data.padded_batch(
+            batch_size, ({"seq": (1, freqs, -1), "id": ()}, (1,)))
+    else:
+        data = data.padded_batch(batch_size, ((1, freqs, -1), (1,)))
     if subset == "train":
         data = data.repeat()
+    elif batch_cache:
+        os.makedirs(batch_cache, exist_ok=True)
+        data = data.cache(os.path.join(batch_cache, "batches_" + key))
+    return data.prefetch(4)
+
+
+# batches kept in memory per process, see replay_batches
+_BATCH_CACHE = dict()
+
+
+def replay_batches(key, build_dataset):
+    """Dataset that replays batches from memory, computing them only once.
+
+    Parameters:
+        key: Identifies the batches, see batch_cache_key.
+        build_dataset: Function that creates the (finite) dataset of batches.
+                       Only called if nothing is cached for key yet. This
+                       happens in a separate graph.
+
+    Returns:
+        tf.data.Dataset giving the same batches as build_dataset would.
+    """
+    if key not in _BATCH_CACHE:
+        print("Caching batches in memory...")
+        with tf.Graph().as_default():
+            data = build_dataset()
+            next_batch = data.make_one_shot_iterator().get_next()
+            batches = []
+            with tf.Session() as sess:
+                try:
+                    while True:
+                        batches.append(sess.run(next_batch))
+                except tf.errors.OutOfRangeError:
+                    pass
+        _BATCH_CACHE[key] = (batches, data.output_types, data.output_shapes)
+
+    batches, types, shapes = _BATCH_CACHE[key]
+    return tf.data.Dataset.from_generator(lambda: iter(batches), types,
+                                          shapes).prefetch(4)
+
+
+def batch_cache_key(paths, *settings):
+    """Key for cached batches, from the files (with their modification times)
+    and any settings that change the batches."""
+    parts = ["{}:{}".format(os.path.abspath(path), os.path.getmtime(path))
+             for path in paths] + [str(setting) for setting in settings]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+
+def wav_input_fn(filenames, batch_size, freqs, threshold, transform,
+                 resample_rate=None, n_workers=1, cache=None):
+    """Builds an input function that reads audio files directly.
+
+    Files are decoded and transformed on the fly (optionally in several
+    processes), so no TFRecords are needed. Files that can't be read are
+    skipped.
+
+    Parameters:
+        filenames: List of paths to audio files.
+        batch_size: See input_fn.
+        freqs: See input_fn.
+        threshold: See input_fn.
+        transform: Transformation function, see data_utils.prepare_transform.
+        resample_rate: Optional int giving the Hz to resample the data to.
+        n_workers: Number of processes for decoding/transforming.
+        cache: Optional AudioCache to read the files through.
+
+    Returns:
+        get_next op of iterator. Features are a dict with the sequences under
+        "seq" and the position of the file in filenames under "id". Labels
+        are always -1.
+    """
+    def gen():
+        results = process_data_list(
+            [(filename, -1) for filename in filenames], resample_rate,
+            transform, n_workers=n_workers, cache=cache, max_seconds=None,
+            start_method="spawn")  # this runs in a TF thread
+        for ind, result in enumerate(results):
+            if result is not None:
+                yield ({"seq": result[0][None].astype(np.float32), "id": ind},
+                       np.array([-1], dtype=np.int32))
+
+    data = tf.data.Dataset.from_generator(
+        gen, ({"seq": tf.float32, "id": tf.int64}, tf.int32),
+        ({"seq": tf.TensorShape([1, freqs, None]), "id": tf.TensorShape([])},
+         tf.TensorShape([1])))
+    if threshold:
+        data = data.map(lambda features, label: (
+            {"seq": apply_threshold(features["seq"]), "id": features["id"]},
+            label))
+    data = data.padded_batch(
+        batch_size, ({"seq": (1, freqs, -1), "id": ()}, (1,)))
     data = data.prefetch(4)
     iterator = data.make_one_shot_iterator()
     return iterator.get_next()
 
 
-def parse_example(example_proto, threshold):
+def bucket_boundaries_from_records(paths, n_buckets, frontend=None):
+    """Find bucket boundaries that give each bucket ~equally many examples.
+
+    Parameters:
+        paths: List of TFRecords files. Example lengths are taken from their
+               indices if available; otherwise only the shape feature of
+               each example is parsed (the sequences are skipped, not
+               decoded).
+        n_buckets: How many buckets to create.
+        frontend: If the records are raw data read through a frontend (see
+                  make_dataset), pass it here so lengths are converted to
+                  spectrogram frames.
+
+    Returns:
+        List of at most n_buckets-1 increasing ints (duplicates are removed).
+    """
+    index = read_index(paths)
+    if index is not None:
+        lengths = index["shape"][:, -1]
+    else:  # no index; need to go through the records
+        lengths = []
+        with tf.Graph().as_default():
+            shapes = tf.data.TFRecordDataset(paths).batch(4096).map(
+                lambda records: tf.parse_example(
+                    records, {"shape": tf.FixedLenFeature((2,), tf.int64)})[
+                    "shape"]).make_one_shot_iterator().get_next()
+            with tf.Session() as sess:
+                try:
+                    while True:
+                        lengths.extend(sess.run(shapes)[:, -1])
+                except tf.errors.OutOfRangeError:
+                    pass
+    if frontend is not None:  # centered frames
+        lengths = 1 + np.asarray(lengths) // frontend.hop_length
+    return boundaries_from_lengths(lengths, n_buckets)
+
+
+def boundaries_from_lengths(lengths, n_buckets):
+    """Bucket boundaries for a list of example lengths; see
+    bucket_boundaries_from_records."""
+    quantiles = np.percentile(lengths,
+                              np.linspace(0, 100, n_buckets + 1)[1:-1])
+    # bucket i contains lengths in [boundaries[i-1], boundaries[i])
+    return sorted(set(int(q) + 1 for q in quantiles))
+
+
+def parse_example(example_proto, threshold, with_id=False, frontend=None):
     """Parse examples from a TFRecords file.
 
+    All record formats from data_utils.RECORD_VERSIONS are supported; the
+    decoder is chosen per example via the stored version. Records without a
+    version are taken to be the original float_list format.
+
     Parameters:
         example_proto: The thing to parse.
         threshold: See above.
+        with_id: If set, return a dict of sequence and example ID (-1 for
+                 augmented examples and old records without ID) instead of
+                 only the sequence.
+        frontend: Optional features.FeatureExtractor to compute spectrograms
+                  from raw records with. See spectrogram.
 
     Returns: 
         The parsed thing. Note: This is always channels_first!
     """
-    # TODO look into better ways of doing this
-    # (SequenceExample sucks, maybe try bytes) (compare speeds!!)
     features = {"seq": tf.VarLenFeature(tf.float32),
+                "seq_bytes": tf.FixedLenFeature((), tf.string,
+                                                default_value=""),
                 "shape": tf.FixedLenFeature((2,), tf.int64),
-                "label": tf.FixedLenFeature((1,), tf.int64)}
+                "label": tf.FixedLenFeature((1,), tf.int64),
+                "version": tf.FixedLenFeature((1,), tf.int64,
+                                              default_value=[1]),
+                "id": tf.FixedLenFeature((), tf.int64, default_value=-1)}
     parsed_features = tf.parse_single_example(example_proto, features)
-    sparse_seq = parsed_features["seq"]
     shape = tf.cast(parsed_features["shape"], tf.int32)
-    dense_seq = tf.reshape(tf.sparse_to_dense(
-        sparse_seq.indices, sparse_seq.dense_shape, sparse_seq.values),
-                           shape)
+    version = parsed_features["version"][0]
+
+    def from_float_list():
+        sparse_seq = parsed_features["seq"]
+        return tf.reshape(tf.sparse_to_dense(
+            sparse_seq.indices, sparse_seq.dense_shape, sparse_seq.values),
+                          shape)
+
+    def from_bytes(dtype):
+        def decode():
+            return tf.reshape(tf.cast(
+                tf.decode_raw(parsed_features["seq_bytes"], dtype),
+                tf.float32), shape)
+        return decode
+
+    dense_seq = tf.case(
+        {tf.equal(version, RECORD_VERSIONS["float32"]):
+             from_bytes(tf.float32),
+         tf.equal(version, RECORD_VERSIONS["float16"]):
+             from_bytes(tf.float16)},
+        default=from_float_list, exclusive=True)
+    if frontend is not None:  # raw data is 1 x time
+        dense_seq = spectrogram(dense_seq[0], frontend)
     # add fake channel/height axis in any case
     dense_seq = tf.expand_dims(dense_seq, axis=0)
     if threshold:
-        dense_seq = tf.maximum(
-            dense_seq, tf.reduce_max(dense_seq) - 8.*tf.log(10.))
-    return dense_seq, tf.cast(parsed_features["label"], tf.int32)
+        dense_seq = apply_threshold(dense_seq)
+    label = tf.cast(parsed_features["label"], tf.int32)
+    if with_id:
+        return {"seq": dense_seq, "id": parsed_features["id"]}, label
+    return dense_seq, label
+
+
+def spectrogram(waveform, frontend):
+    """Compute features of a waveform in the graph.
+
+    Does the same as features.FeatureExtractor (using its window and mel
+    filterbank), so models can be trained on raw records and later be used
+    with precomputed features or vice versa.
+
+    Parameters:
+        waveform: 1D float32 tensor.
+        frontend: features.FeatureExtractor.
+
+    Returns:
+        freqs x time tensor.
+    """
+    pad = frontend.window_size // 2
+    padded = tf.pad(waveform, [[pad, pad]], mode="REFLECT")
+    frames = tf.contrib.signal.frame(padded, frontend.window_size,
+                                     frontend.hop_length)
+    spectrum = tf.abs(tf.spectral.rfft(frames * frontend.window))
+    if frontend.mel_basis is not None:
+        spectrum = tf.matmul(tf.square(spectrum), frontend.mel_basis)
+    if frontend.log_floor is None:
+        return tf.transpose(tf.log(spectrum))
+    features = tf.log(tf.maximum(spectrum, frontend.amin))
+    return tf.transpose(tf.maximum(features, tf.reduce_max(features) -
+                                   frontend.log_floor))
+
+
+def augment_dataset(augment_pool, freqs, threshold):
+    """Endless dataset of examples mixed on the fly.
+
+    Parameters:
+        augment_pool: augment.AugmentationPool to generate examples from.
+        freqs: See input_fn.
+        threshold: See input_fn.
+
+    Returns:
+        tf.data.Dataset with elements in the same format as parse_example.
+    """
+    def gen():
+        for seq, label, _, _ in augment_pool.generate(None):
+            yield seq[None].astype(np.float32), np.array([label], np.int32)
+
+    data = tf.data.Dataset.from_generator(
+        gen, (tf.float32, tf.int32),
+        (tf.TensorShape([1, freqs, None]), tf.TensorShape([1])))
+    if threshold:
+        data = data.map(lambda seq, label: (apply_threshold(seq), label))
+    return data
+
+
+def random_crop(seq, width):
+    """Randomly crop or pad a sequence to a fixed number of time steps.
+
+    Parameters:
+        seq: 1 x freqs x time tensor.
+        width: Desired number of time steps.
+
+    Returns:
+        1 x freqs x width tensor. Sequences that are too short are padded with
+        zeros at a random position, like data_utils.random_pad.
+    """
+    diff = tf.maximum(width - tf.shape(seq)[-1], 0)
+    front = tf.random_uniform((), maxval=diff + 1, dtype=tf.int32)
+    seq = tf.pad(seq, [[0, 0], [0, 0], [front, diff - front]])
+    start = tf.random_uniform((), maxval=tf.shape(seq)[-1] - width + 1,
+                              dtype=tf.int32)
+    cropped = seq[:, :, start:(start + width)]
+    cropped.set_shape([1, seq.shape[1], width])
+    return cropped
+
+
+def apply_threshold(seq):
+    """Remove anything 80db below the maximum of a sequence."""
+    return tf.maximum(seq, tf.reduce_max(seq) - 8.*tf.log(10.))
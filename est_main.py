@@ -1,27 +1,54 @@
 import os
+import time
 
-import numpy as np
 import tensorflow as tf
 
-from data_utils import read_data_config, make_labeled_data_list
-from est_input import input_fn
-from est_models import model_fn
-from utils import checkpoint_iterator
+from audio_cache import cache_from_config
+from augment import AugmentationPool
+from data_utils import dev_inds_of, find_tfrecords, load_dev_set, \
+    make_labeled_data_list, make_unlabeled_data_list, match_predictions, \
+    prepare_frontend, prepare_transform, read_data_config, read_durations, \
+    read_index, time_steps
+from detect import run_detection, window_geometry
+from est_input import boundaries_from_lengths, \
+    bucket_boundaries_from_records, input_fn, wav_input_fn
+from est_models import SCORE_KEYS, model_fn, total_stride_of
+from evaluate import run_evaluation
+from export import export_model
+from hooks import InputStallHook
 
 
 def run_birds(mode, data_config, model_config, model_dir,
-              act, batchnorm,
-              adam_params, augment, batch_size, clipping, data_format,
-              label_smoothing, normalize, onedim, reg, renorm, steps,
-              threshold, use_avg, vis):
+              act, activations, batchnorm,
+              adam_params, augment, batch_size, bucket_batch_sizes,
+              bucket_boundaries, clipping, crop_width, data_format,
+              detect_threshold, eval_cache, frame_scores, hop_seconds,
+              input_stats, label_smoothing, n_buckets, normalize, onedim,
+              online_augment, out_file, profile_window, reg, renorm, steps,
+              threshold, timeline, use_avg, vis, wav_dir, window_seconds,
+              workers):
     """
     All of these parameters can be passed from est_cli. Please check
     that one for docs on what they are.
     
     Returns:
         Depends on mode!
-        If train or eval: Nothing is returned.
+        If train or eval: Nothing is returned. Eval evaluates every checkpoint
+                          in model_dir that has not been evaluated before
+                          (see evaluate.run_evaluation).
         If predict: Returns a generator over predictions for the test set.
+                    Layer activations (and the input) are only included if
+                    activations is set; otherwise only the scores are fetched
+                    from the model.
+        If export: Nothing is returned. The latest checkpoint is written as
+                   a frozen inference graph (with batch norm folded into the
+                   conv weights) to model_dir/export. Use serve.py with it.
+        If infer: Nothing is returned. Probabilities for all files in wav_dir
+                  are written to out_file.
+        If detect: Nothing is returned. Files in wav_dir (of any length) are
+                   scored in sliding windows; segments with birds are
+                   written to out_file (see detect.run_detection). With
+                   frame_scores, many windows are scored per forward pass.
         If return: Return the estimator object. Use this if you want access to
                    the variables or their values, for example.
     """
@@ -37,6 +64,18 @@ def run_birds(mode, data_config, model_config, model_dir,
         freqs = config_dict["window_size"] // 2 + 1
     else:
         freqs = 1
+    frontend = prepare_frontend(config_dict)
+
+    if mode == "export":
+        checkpoint = tf.train.latest_checkpoint(model_dir)
+        if checkpoint is None:
+            raise ValueError("No checkpoint found in {}.".format(model_dir))
+        export_model(checkpoint, os.path.join(model_dir, "export"),
+                     model_config, config_dict, freqs=freqs, act=act,
+                     batchnorm=batchnorm, data_format=data_format,
+                     onedim=onedim, normalize=normalize, threshold=threshold,
+                     use_avg=use_avg)
+        return
 
     if act == "elu":
         act = tf.nn.elu
@@ -55,7 +94,15 @@ def run_birds(mode, data_config, model_config, model_dir,
               "label_smoothing": label_smoothing,
               "normalize": normalize,
               "renorm": renorm,
-              "use_avg": use_avg}
+              "use_avg": use_avg,
+              "profile_window": profile_window,
+              "timeline": timeline}
+    if mode == "detect" and frame_scores:
+        # all files are brought to one rate so the window size is fixed
+        detect_rate = config_dict["resample_rate"] or 44100
+        params["score_window"] = window_geometry(
+            detect_rate, window_seconds, hop_seconds,
+            prepare_transform(config_dict) or frontend)[:2]
 
     # we set infrequent "permanent" checkpoints
     # we also disable the default SummarySaverHook IF profiling is requested
@@ -71,60 +118,166 @@ def run_birds(mode, data_config, model_config, model_dir,
         return estimator
 
     if mode == "train":
+        augment_pool = None
+        if online_augment:
+            if not config_dict["n_augment"]:
+                raise ValueError("Online augmentation requested, but n_augment"
+                                 " is not set in the data config.")
+            data_list = make_labeled_data_list(
+                config_dict["data_dir"], config_dict["datasets"],
+                config_dict["n_max"])
+            dev_inds = set(dev_inds_of(data_list, load_dev_set(
+                config_dict["dev_inds"], data_list)[0]))
+            augment_pool = AugmentationPool.from_data_list(
+                data_list,
+                [ind for ind in range(len(data_list)) if ind not in dev_inds],
+                resample_rate=config_dict["resample_rate"],
+                transform=prepare_transform(config_dict) or frontend,
+                cache=cache_from_config(config_dict))
+
+        if n_buckets and not bucket_boundaries:
+            train_paths = find_tfrecords(tfr_path, "train")
+            if read_index(train_paths) is None and config_dict["durations"]:
+                # no need to go through the records; includes dev files, but
+                # that's close enough
+                bucket_boundaries = boundaries_from_lengths(
+                    [time_steps(duration, sr, config_dict) for duration, sr
+                     in read_durations(config_dict["durations"]).values()],
+                    n_buckets)
+            else:
+                bucket_boundaries = bucket_boundaries_from_records(
+                    train_paths, n_buckets, frontend)
+            print("Using bucket boundaries {}".format(bucket_boundaries))
+
         def train_input_fn(): return input_fn(
             tfr_path, "train", freqs=freqs, batch_size=batch_size,
-            augment=augment, threshold=threshold)
+            augment=augment or online_augment, threshold=threshold,
+            augment_pool=augment_pool, n_augment=config_dict["n_augment"],
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=bucket_batch_sizes, crop_width=crop_width,
+            frontend=frontend)
 
         logging_hook = tf.train.LoggingTensorHook(
             {"eval/accuracy": "eval/batch_accuracy"},
             every_n_iter=vis,
             at_end=True)
+        train_hooks = [logging_hook]
+        if input_stats:
+            train_hooks.append(InputStallHook(every_n_steps=vis or 100,
+                                              output_dir=model_dir))
         estimator.train(input_fn=train_input_fn, steps=steps,
-                        hooks=[logging_hook])
+                        hooks=train_hooks)
 
     elif mode == "eval":
-        def eval_input_fn():
-            return input_fn(
-                tfr_path, "dev", freqs=freqs, batch_size=batch_size,
-                augment=False, threshold=threshold)
-
-        for ckpt in checkpoint_iterator(os.path.join(model_dir, "checkpoint")):
-            print("Evaluating checkpoint {}...".format(ckpt))
-            eval_results = estimator.evaluate(input_fn=eval_input_fn)
-            print("Evaluation results:\n", eval_results)
+        run_evaluation(model_dir,
+                       {"data_path": tfr_path, "batch_size": batch_size,
+                        "freqs": freqs, "threshold": threshold,
+                        "batch_cache": eval_cache, "frontend": frontend},
+                       params, n_workers=workers)
         return
 
     elif mode == "predict":
-        def eval_input_fn():
+        def predict_input_fn():
             return input_fn(
                 tfr_path, "dev", freqs=freqs, batch_size=batch_size,
-                augment=False, threshold=threshold)
+                augment=False, threshold=threshold, with_ids=True,
+                batch_cache=eval_cache, frontend=frontend)
 
-        orig_data = make_labeled_data_list(
-            config_dict["data_dir"], config_dict["datasets"])
-        dev_inds = set(np.load(config_dict["dev_inds"]))
-        dev_data = [d for i, d in enumerate(orig_data) if i in dev_inds]
+        dev_index = read_index(find_tfrecords(tfr_path, "dev"))
+        if dev_index is None:
+            print("Warning!! No index found for the dev TFRecords (old "
+                  "data). Matching predictions to files by their position in "
+                  "the dev set instead, which is wrong if any files were "
+                  "skipped when the records were created. Recreate the data "
+                  "to fix this.")
+            data_list = make_labeled_data_list(
+                config_dict["data_dir"], config_dict["datasets"],
+                config_dict["n_max"])
+            dev_data = [data_list[ind] for ind in dev_inds_of(
+                data_list, load_dev_set(config_dict["dev_inds"],
+                                        data_list)[0])]
+            dev_ids = None
+        else:
+            dev_data = list(zip(dev_index["file"], dev_index["label"]))
+            dev_ids = dev_index["id"]
+
+        predict_keys = None if activations else SCORE_KEYS + ["id"]
 
         def gen():
-            for data, predictions in zip(
-                    dev_data, estimator.predict(input_fn=eval_input_fn)):
+            for predictions, filename, label in match_predictions(
+                    estimator.predict(input_fn=predict_input_fn,
+                                      predict_keys=predict_keys),
+                    dev_data, dev_ids):
                 predictions_repacked = dict()
 
-                # construct a sorted list of layers and their activations, with
-                # input and front
-                layers = [(n, a) for (n, a) in predictions.items() if
-                          leading_string(n) in ["layer", "pool"]]
-                layers.sort(key=lambda tup: trailing_num(tup[0]))
-                layers.insert(0, ("input", predictions["input"]))
+                if activations:
+                    # construct a sorted list of layers and their activations,
+                    # with input and front
+                    layers = [(n, a) for (n, a) in predictions.items() if
+                              leading_string(n) in ["layer", "pool"]]
+                    layers.sort(key=lambda tup: trailing_num(tup[0]))
+                    layers.insert(0, ("input", predictions["input"]))
 
-                predictions_repacked["all_layers"] = layers
-                for k in ["flattened", "logits", "probabilities", "classes"]:
+                    predictions_repacked["all_layers"] = layers
+                    predictions_repacked["flattened"] = \
+                        predictions["flattened"]
+                for k in SCORE_KEYS:
                     predictions_repacked[k] = predictions[k]
-                predictions_repacked["label"] = data[1]
-                predictions_repacked["file"] = data[0]
+                predictions_repacked["label"] = int(label)
+                predictions_repacked["file"] = filename
                 yield predictions_repacked
         return gen()
 
+    elif mode == "infer":
+        if not wav_dir or not out_file:
+            raise ValueError("Inference needs a wav_dir and an out_file.")
+        filenames = [filename for filename, _ in
+                     make_unlabeled_data_list(wav_dir)]
+        transform = prepare_transform(config_dict) or frontend
+
+        def infer_input_fn():
+            return wav_input_fn(
+                filenames, batch_size=batch_size, freqs=freqs,
+                threshold=threshold, transform=transform,
+                resample_rate=config_dict["resample_rate"],
+                n_workers=workers, cache=cache_from_config(config_dict))
+
+        start = time.time()
+        n_done = 0
+        with open(out_file, mode="w") as out:
+            out.write("file,probability\n")
+            for predictions in estimator.predict(
+                    input_fn=infer_input_fn,
+                    predict_keys=["id", "probabilities"]):
+                out.write("{},{}\n".format(filenames[predictions["id"]],
+                                           predictions["probabilities"][0]))
+                n_done += 1
+                if n_done % 1000 == 0:
+                    print("Scored {} clips ({:.1f} clips/sec)".format(
+                        n_done, n_done / (time.time() - start)))
+        print("Scored {} of {} clips in {:.1f} seconds ({:.1f} "
+              "clips/sec).".format(n_done, len(filenames),
+                                   time.time() - start,
+                                   n_done / (time.time() - start)))
+        return
+
+    elif mode == "detect":
+        if not wav_dir or not out_file:
+            raise ValueError("Detection needs a wav_dir and an out_file.")
+        run_detection(estimator,
+                      [filename for filename, _ in
+                       make_unlabeled_data_list(wav_dir)],
+                      out_file, batch_size=batch_size, freqs=freqs,
+                      threshold=threshold, window_seconds=window_seconds,
+                      hop_seconds=hop_seconds,
+                      detect_threshold=detect_threshold,
+                      extractor=prepare_transform(config_dict) or frontend,
+                      resample_rate=(detect_rate if frame_scores else
+                                     config_dict["resample_rate"]),
+                      total_stride=(total_stride_of(model_config)
+                                    if frame_scores else None))
+        return
+
     else:
         print("Mode unknown. Doing nothing...")
         return
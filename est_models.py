@@ -1,8 +1,14 @@
+import os
+
 import tensorflow as tf
 
 from hooks import SummarySaverHookWithProfile
 
 
+# the cheap prediction outputs; everything else are (large) activations
+SCORE_KEYS = ["logits", "probabilities", "classes"]
+
+
 def model_fn(features, labels, mode, params, config):
     """Model function for tf.estimator.
 
@@ -10,6 +16,8 @@ def model_fn(features, labels, mode, params, config):
         features: Should be a batch_size x channels x height x width tensor of
                   input sequences.
                   Note: Must be channels_first!!
+                  Can also be a dict with this tensor under "seq" and example
+                  IDs under "id". The IDs are passed on to the predictions.
         labels: batch_size tensor of class labels.
         mode: Train, Evaluate or Predict modes from tf.estimator.
         params: Should be a dict with the following string keys:
@@ -34,6 +42,18 @@ def model_fn(features, labels, mode, params, config):
             normalize: Normalize inputs to mean 0 and variance 1.
             renorm: Use batch renormalization.
             use_avg: Average-pool at the end instead of max-pool.
+            score_window: Optional tuple window, hop in input time steps.
+                          If given, predictions include "window_logits": the
+                          logits of all windows of that size at that hop in
+                          each input, from one forward pass (see
+                          window_logits). Optional.
+            profile_window: Number of consecutive steps to profile each time
+                            profiling is due (see
+                            hooks.SummarySaverHookWithProfile). Optional,
+                            default 1.
+            timeline: If true, Chrome traces of profiled steps and their time
+                      by op type are also written to model_dir/timeline.
+                      Optional.
         config: RunConfig object passed through from Estimator.
 
     Returns:
@@ -54,6 +74,16 @@ def model_fn(features, labels, mode, params, config):
     renorm = params["renorm"]
     use_avg = params["use_avg"]
 
+    example_ids = None
+    if isinstance(features, dict):
+        example_ids = features["id"]
+        features = features["seq"]
+
+    if mode == tf.estimator.ModeKeys.TRAIN:
+        # batch shapes vary with bucketing; needed to make sense of steps/sec
+        tf.summary.scalar("input/batch_size", tf.shape(features)[0])
+        tf.summary.scalar("input/batch_time_steps", tf.shape(features)[-1])
+
     # model input -> output
     with tf.variable_scope("model"):
         if normalize:
@@ -94,6 +124,19 @@ def model_fn(features, labels, mode, params, config):
                        "flattened": flattened}
         for name, act in all_layers:
             predictions[name] = act
+        if mode == tf.estimator.ModeKeys.PREDICT:
+            # dense scores from the same forward pass; only computed if
+            # requested via predict_keys
+            frames = frame_features(pre_out, data_format)
+            predictions["frame_logits"] = tf.layers.dense(
+                frames, 1, activation=None, name="logits", reuse=True)[:, :, 0]
+            if params.get("score_window"):
+                predictions["window_logits"] = window_logits(
+                    frames, *score_window_frames(*params["score_window"],
+                                                 total_stride),
+                    use_avg=use_avg)
+        if example_ids is not None:
+            predictions["id"] = example_ids
         if mode == tf.estimator.ModeKeys.PREDICT:
             return tf.estimator.EstimatorSpec(mode=mode,
                                               predictions=predictions)
@@ -139,7 +182,10 @@ def model_fn(features, labels, mode, params, config):
         if vis:
             save_and_profile = SummarySaverHookWithProfile(
                 save_steps=vis, profile_steps=50*vis,
-                output_dir=config.model_dir, scaffold=scaff)
+                output_dir=config.model_dir, scaffold=scaff,
+                profile_window=params.get("profile_window", 1),
+                timeline_dir=(os.path.join(config.model_dir, "timeline")
+                              if params.get("timeline") else None))
             hooks.append(save_and_profile)
         return tf.estimator.EstimatorSpec(mode=mode, loss=cross_ent,
                                           train_op=train_op, scaffold=scaff,
@@ -167,6 +213,67 @@ def model_fn(features, labels, mode, params, config):
                                       eval_metric_ops=eval_metric_ops)
 
 
+def frame_features(pre_out, data_format):
+    """Features per output time step, for applying the logits layer to each.
+
+    Parameters:
+        pre_out: Output of read_apply_model_config.
+        data_format: See model_fn.
+
+    Returns:
+        batch x time x features tensor. Features are in the same order as in
+        "flattened" in model_fn, so flattened equals these features reduced
+        over time.
+    """
+    if data_format == "channels_first":  # b x c x h x t
+        frames = tf.transpose(pre_out, [0, 3, 1, 2])
+    else:  # b x h x t x c
+        frames = tf.transpose(pre_out, [0, 2, 1, 3])
+    n_features = int(frames.shape[2]) * int(frames.shape[3])
+    return tf.reshape(frames, [tf.shape(frames)[0], tf.shape(frames)[1],
+                               n_features])
+
+
+def window_logits(frames, window, hop, use_avg):
+    """Logits of all windows in a sequence, from frame features.
+
+    Pooling the features over a window and then applying the logits layer is
+    exactly what model_fn does for a whole input. So this gives the scores
+    the model would give each window on its own, except that convolutions
+    near the window edges see the neighbouring audio instead of padding.
+
+    Parameters:
+        frames: Output of frame_features.
+        window: Window size in output time steps.
+        hop: Hop between windows in output time steps.
+        use_avg: See model_fn.
+
+    Returns:
+        batch x windows tensor. Only windows that fit into the input
+        completely are included.
+    """
+    pool_fun = tf.layers.average_pooling1d if use_avg else \
+        tf.layers.max_pooling1d
+    pooled = pool_fun(frames, window, hop, padding="valid")
+    return tf.layers.dense(pooled, 1, activation=None, name="logits",
+                           reuse=True)[:, :, 0]
+
+
+def score_window_frames(window, hop, total_stride):
+    """Window and hop in output time steps, from input time steps."""
+    return (max(1, int(round(window / total_stride))),
+            max(1, int(round(hop / total_stride))))
+
+
+def total_stride_of(model_config):
+    """Total stride of the model in a config file (see
+    read_apply_model_config), without building it."""
+    total_stride = 1
+    for _, _, _, s_f in read_model_config(model_config):
+        total_stride *= s_f
+    return total_stride
+
+
 ###############################################################################
 # Helper functions for building inference models.
 ###############################################################################
@@ -212,47 +319,55 @@ def read_apply_model_config(config_path, inputs, act, batchnorm, train,
         of all layer/block activations with their names (tuples name, act).
     """
     # TODO for resnets/dense nets, return all *layers*, not just blocks
-
-    def parse_line(l):
-        entries = l.strip().split(",")
-        return entries[0], int(entries[1]), int(entries[2]), int(entries[3])
-
     print("Reading, building and applying model...")
     total_pars = 0
     all_layers = []
-    with open(config_path) as model_config:
-        total_stride = 1
-        previous = inputs
-        for ind, line in enumerate(model_config):
-            t, n_f, w_f, s_f = parse_line(line)
-            name = t + str(ind)
-            if t == "layer":
-                previous, pars = conv_layer(
-                    previous, n_f, w_f, s_f, act, batchnorm, train,
-                    data_format, vis, name=name, reg=reg, onedim=onedim,
-                    renorm=renorm)
-            elif t == "pool":
-                if onedim:
-                    previous = tf.layers.max_pooling2d(
-                        previous, (1, w_f), (1, s_f), padding="same",
-                        data_format=data_format, name=name)
-                else:
-                    previous = tf.layers.max_pooling2d(
-                        previous, w_f, s_f, padding="same",
-                        data_format=data_format, name=name)
-                pars = 0
+    total_stride = 1
+    previous = inputs
+    for ind, (t, n_f, w_f, s_f) in enumerate(read_model_config(config_path)):
+        name = t + str(ind)
+        if t == "layer":
+            previous, pars = conv_layer(
+                previous, n_f, w_f, s_f, act, batchnorm, train,
+                data_format, vis, name=name, reg=reg, onedim=onedim,
+                renorm=renorm)
+        elif t == "pool":
+            if onedim:
+                previous = tf.layers.max_pooling2d(
+                    previous, (1, w_f), (1, s_f), padding="same",
+                    data_format=data_format, name=name)
             else:
-                raise ValueError(
-                    "Invalid layer type specified in layer {}! Valid are "
-                    "'layer', 'pool'. You specified "
-                    "{}.".format(ind, t))
-            all_layers.append((name, previous))
-            total_stride *= s_f
-            total_pars += pars
+                previous = tf.layers.max_pooling2d(
+                    previous, w_f, s_f, padding="same",
+                    data_format=data_format, name=name)
+            pars = 0
+        else:
+            raise ValueError(
+                "Invalid layer type specified in layer {}! Valid are "
+                "'layer', 'pool'. You specified "
+                "{}.".format(ind, t))
+        all_layers.append((name, previous))
+        total_stride *= s_f
+        total_pars += pars
     print("Number of model parameters: {}".format(total_pars))
     return previous, total_stride, all_layers
 
 
+def read_model_config(config_path):
+    """Read a model config file (see read_apply_model_config).
+
+    Returns:
+        List of tuples type, n_f, w_f, s_f; one per line.
+    """
+    layers = []
+    with open(config_path) as model_config:
+        for line in model_config:
+            entries = line.strip().split(",")
+            layers.append((entries[0], int(entries[1]), int(entries[2]),
+                           int(entries[3])))
+    return layers
+
+
 def conv_layer(inputs, n_filters, size_filters, stride_filters, act,
                batchnorm, train, data_format, vis, name, reg, onedim,
                renorm):
@@ -0,0 +1,218 @@
+import glob
+import json
+import multiprocessing
+import os
+import queue as queue_module
+import traceback
+
+import numpy as np
+import tensorflow as tf
+
+from est_input import make_dataset
+from est_models import model_fn
+
+
+RESULTS_FILE = "eval_results.jsonl"
+# how often (seconds) to check whether workers are still alive
+WORKER_CHECK_SECS = 10
+
+
+def list_checkpoints(model_dir):
+    """Find all complete checkpoints in a model directory.
+
+    The checkpoint state file is not used, so checkpoints that were dropped
+    from it (e.g. the "permanent" ones) are found as well. A checkpoint
+    counts as complete once its .index file exists, which is written after
+    the variables.
+
+    Returns:
+        List of tuples global step, checkpoint path (prefix); sorted by step.
+    """
+    checkpoints = []
+    for index_file in glob.glob(os.path.join(model_dir, "model.ckpt-*.index")):
+        prefix = index_file[:-len(".index")]
+        checkpoints.append((int(prefix.rsplit("-", 1)[1]), prefix))
+    return sorted(checkpoints)
+
+
+def read_results(model_dir):
+    """Read all results recorded so far; dict checkpoint name -> results."""
+    results = dict()
+    path = os.path.join(model_dir, RESULTS_FILE)
+    if os.path.exists(path):
+        with open(path) as results_file:
+            for line in results_file:
+                entry = json.loads(line)
+                results[entry["checkpoint"]] = entry
+    return results
+
+
+def run_evaluation(model_dir, data_args, params, n_workers=1):
+    """Evaluate all checkpoints in model_dir that haven't been evaluated yet.
+
+    Each worker builds the evaluation graph once and only restores weights
+    per checkpoint. The checkpoint state file is never touched, so this is
+    safe to run while training is still going on. Results are appended to
+    RESULTS_FILE in model_dir as soon as they come in, and written as
+    summaries to model_dir/eval like Estimator.evaluate does.
+
+    Parameters:
+        model_dir: Where the checkpoints are.
+        data_args: Dict of arguments for est_input.make_dataset (without
+                   subset, which is always dev).
+        params: Params dict for est_models.model_fn.
+        n_workers: Number of processes to spread the checkpoints over. If 1,
+                   everything happens in this process.
+
+    Returns:
+        Dict checkpoint name -> results, for all checkpoints evaluated now
+        or in earlier runs.
+    """
+    done = read_results(model_dir)
+    todo = [(step, ckpt) for step, ckpt in list_checkpoints(model_dir)
+            if os.path.basename(ckpt) not in done]
+    print("{} checkpoints already evaluated, {} to go.".format(len(done),
+                                                               len(todo)))
+    if not todo:
+        return done
+
+    batch_cache = data_args.get("batch_cache")
+    if n_workers > 1 and batch_cache and batch_cache != "memory":
+        # fill the cache file first; workers can't all write it at once
+        warm_batch_cache(data_args)
+
+    writer = tf.summary.FileWriterCache.get(os.path.join(model_dir, "eval"))
+    with open(os.path.join(model_dir, RESULTS_FILE), mode="a") as \
+            results_file:
+        for entry in _evaluate_distributed(todo, data_args, params,
+                                           n_workers):
+            print("Evaluation results for {}:\n".format(entry["checkpoint"]),
+                  entry)
+            results_file.write(json.dumps(entry) + "\n")
+            results_file.flush()
+            summary = tf.Summary(value=[
+                tf.Summary.Value(tag=k, simple_value=v)
+                for k, v in entry.items()
+                if k not in ["checkpoint", "global_step"]])
+            writer.add_summary(summary, entry["global_step"])
+            done[entry["checkpoint"]] = entry
+    writer.flush()
+    return done
+
+
+def warm_batch_cache(data_args):
+    """Go through the dev data once so its batch cache file gets written."""
+    with tf.Graph().as_default():
+        next_batch = make_dataset(
+            subset="dev", augment=False,
+            **data_args).make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            try:
+                while True:
+                    sess.run(next_batch)
+            except tf.errors.OutOfRangeError:
+                pass
+
+
+def _evaluate_distributed(checkpoints, data_args, params, n_workers):
+    """Generator over results, from this process or from several workers."""
+    if n_workers <= 1:
+        yield from evaluate_checkpoints(checkpoints, data_args, params)
+        return
+
+    # functions don't travel well between processes
+    params = dict(params, act=params["act"].__name__)
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    workers = [context.Process(target=_worker,
+                               args=(ind, checkpoints[ind::n_workers],
+                                     data_args, params, queue))
+               for ind in range(min(n_workers, len(checkpoints)))]
+    for worker in workers:
+        worker.start()
+    running = set(range(len(workers)))
+    try:
+        while running:
+            try:
+                kind, ind, payload = queue.get(timeout=WORKER_CHECK_SECS)
+            except queue_module.Empty:
+                # a worker that dies without reporting (e.g. killed, or
+                # crashed before it got going) would leave us waiting forever
+                dead = sorted(ind for ind in running
+                              if workers[ind].exitcode is not None)
+                if dead:
+                    raise RuntimeError(
+                        "Evaluation worker(s) {} died with exit code(s) "
+                        "{}.".format(dead, [workers[ind].exitcode
+                                            for ind in dead]))
+                continue
+            if kind == "result":
+                yield payload
+            elif kind == "done":
+                running.discard(ind)
+            else:
+                raise RuntimeError("Evaluation worker {} failed:\n{}".format(
+                    ind, payload))
+    finally:
+        for worker in workers:
+            if worker.is_alive() and running:
+                worker.terminate()
+            worker.join()
+
+
+def _worker(ind, checkpoints, data_args, params, queue):
+    """Evaluate checkpoints in a worker process.
+
+    Sends tuples kind, ind, payload to queue: ("result", ind, entry) for each
+    checkpoint, then ("done", ind, None), or ("error", ind, traceback) if
+    something goes wrong.
+    """
+    try:
+        params["act"] = getattr(tf.nn, params["act"])
+        for entry in evaluate_checkpoints(checkpoints, data_args, params):
+            queue.put(("result", ind, entry))
+    except Exception:
+        queue.put(("error", ind, traceback.format_exc()))
+        raise
+    queue.put(("done", ind, None))
+
+
+def evaluate_checkpoints(checkpoints, data_args, params):
+    """Evaluate checkpoints one after the other on the same graph.
+
+    Parameters:
+        checkpoints: List of tuples global step, checkpoint path.
+        data_args: See run_evaluation.
+        params: See run_evaluation.
+
+    Returns:
+        Generator over dicts with checkpoint name, global step, loss and all
+        eval metrics of est_models.model_fn.
+    """
+    with tf.Graph().as_default():
+        iterator = make_dataset(
+            subset="dev", augment=False,
+            **data_args).make_initializable_iterator()
+        features, labels = iterator.get_next()
+        spec = model_fn(features, labels, tf.estimator.ModeKeys.EVAL, params,
+                        config=None)
+        values = {k: v for k, (v, _) in spec.eval_metric_ops.items()}
+        updates = [update for (_, update) in spec.eval_metric_ops.values()]
+        saver = tf.train.Saver()
+        reset = [iterator.initializer, tf.local_variables_initializer()]
+
+        with tf.Session() as sess:
+            for step, ckpt in checkpoints:
+                saver.restore(sess, ckpt)
+                sess.run(reset)
+                losses = []
+                try:
+                    while True:
+                        losses.append(sess.run([spec.loss, updates])[0])
+                except tf.errors.OutOfRangeError:
+                    pass
+                entry = {k: float(v) for k, v in sess.run(values).items()}
+                entry["loss"] = float(np.mean(losses))
+                entry["checkpoint"] = os.path.basename(ckpt)
+                entry["global_step"] = step
+                yield entry
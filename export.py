@@ -0,0 +1,172 @@
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from est_models import read_model_config
+
+
+GRAPH_FILE = "inference_graph.pb"
+CONFIG_FILE = "inference_config.json"
+INPUT_NAME = "input"
+OUTPUT_NAME = "probabilities"
+
+
+def fold_batchnorm(kernel, gamma, beta, moving_mean, moving_variance,
+                   epsilon=1e-3):
+    """Fold inference-mode batch normalization into a convolution.
+
+    Parameters:
+        kernel: Convolution kernel with output channels on the last axis.
+        gamma, beta, moving_mean, moving_variance: Batch norm variables.
+        epsilon: Batch norm epsilon (the tf.layers default is 1e-3).
+
+    Returns:
+        Kernel and bias such that conv(x, kernel) + bias gives the same result
+        as batch_norm(conv(x, kernel)).
+    """
+    scale = gamma / np.sqrt(moving_variance + epsilon)
+    return kernel * scale, beta - moving_mean * scale
+
+
+def read_weights(checkpoint, model_config, batchnorm):
+    """Read model weights from a checkpoint, with batch norm folded in.
+
+    Parameters:
+        checkpoint: Path to the checkpoint (prefix).
+        model_config: Path to the model config file.
+        batchnorm: Whether the model was trained with batch normalization.
+
+    Returns:
+        List of (kernel, bias) for each conv layer (None for pooling layers),
+        in config order, and (kernel, bias) of the logits layer.
+    """
+    reader = tf.train.load_checkpoint(checkpoint)
+    layer_weights = []
+    for ind, (t, _, _, _) in enumerate(read_model_config(model_config)):
+        scope = "model/" + t + str(ind)
+        if t != "layer":
+            layer_weights.append(None)
+            continue
+        kernel = reader.get_tensor(scope + "/conv/kernel")
+        if batchnorm:
+            bn = [reader.get_tensor(scope + "/batch_norm/" + var) for var in
+                  ["gamma", "beta", "moving_mean", "moving_variance"]]
+            layer_weights.append(fold_batchnorm(kernel, *bn))
+        else:
+            layer_weights.append((kernel, reader.get_tensor(
+                scope + "/conv/bias")))
+    logits_weights = (reader.get_tensor("model/logits/kernel"),
+                      reader.get_tensor("model/logits/bias"))
+    return layer_weights, logits_weights
+
+
+def build_inference_graph(model_config, layer_weights, logits_weights, freqs,
+                          act, onedim, normalize, use_avg,
+                          trained_data_format):
+    """Build the model with all weights as constants.
+
+    The graph always uses channels_last so it can run on CPU; weights trained
+    with channels_first are rearranged where needed. Input is a placeholder
+    batch x 1 x freqs x time (like input_fn gives), output are the
+    probabilities. Mirrors est_models.model_fn in inference mode.
+
+    Parameters:
+        model_config: Path to the model config file.
+        layer_weights, logits_weights: As returned by read_weights.
+        freqs: Size of the frequency axis.
+        act: Name of the activation function ("relu" or "elu").
+        onedim, normalize, use_avg: As used for training.
+        trained_data_format: Data format used for training.
+
+    Returns:
+        Input placeholder and probabilities tensor.
+    """
+    act = tf.nn.elu if act == "elu" else tf.nn.relu
+    inputs = tf.placeholder(tf.float32, [None, 1, freqs, None],
+                            name=INPUT_NAME)
+    features = inputs
+    if normalize:
+        means, variances = tf.nn.moments(features, axes=[2, 3],
+                                         keep_dims=True)
+        features = (features - means) / variances
+    if onedim:  # b x 1 x t x 128
+        features = tf.transpose(features, [0, 1, 3, 2])
+    else:  # b x 128 x t x 1
+        features = tf.transpose(features, [0, 2, 3, 1])
+
+    previous = features
+    for (t, _, w_f, s_f), weights in zip(read_model_config(model_config),
+                                         layer_weights):
+        if onedim:
+            window, strides = [1, 1, w_f, 1], [1, 1, s_f, 1]
+        else:
+            window, strides = [1, w_f, w_f, 1], [1, s_f, s_f, 1]
+        if t == "layer":
+            kernel, bias = weights
+            previous = act(tf.nn.bias_add(
+                tf.nn.conv2d(previous, tf.constant(kernel), strides,
+                             padding="SAME"),
+                tf.constant(bias)))
+        else:
+            previous = tf.nn.max_pool(previous, window, strides,
+                                      padding="SAME")
+
+    reduce_fun = tf.reduce_mean if use_avg else tf.reduce_max
+    reduced = reduce_fun(previous, axis=-2)  # b x height x channels
+    flattened = tf.layers.flatten(reduced)
+
+    kernel, bias = logits_weights
+    if trained_data_format == "channels_first":
+        # flattened features were ordered channels x height in training
+        height, channels = int(reduced.shape[1]), int(reduced.shape[2])
+        kernel = kernel.reshape((channels, height, -1)).transpose(
+            (1, 0, 2)).reshape((height * channels, -1))
+    logits = tf.nn.bias_add(tf.matmul(flattened, tf.constant(kernel)),
+                            tf.constant(bias))
+    return inputs, tf.nn.sigmoid(logits, name=OUTPUT_NAME)
+
+
+def export_model(checkpoint, export_dir, model_config, data_config_dict,
+                 freqs, act, batchnorm, data_format, onedim, normalize,
+                 threshold, use_avg):
+    """Write a self-contained inference artifact for a checkpoint.
+
+    The artifact is a folder with a frozen GraphDef (GRAPH_FILE) and a json
+    file (CONFIG_FILE) with everything needed to prepare inputs for it. See
+    serve.py for how to use it.
+
+    Parameters:
+        checkpoint: Path to the checkpoint (prefix).
+        export_dir: Folder to write to. Created if it doesn't exist.
+        model_config: Path to the model config file.
+        data_config_dict: Data config as returned by read_data_config.
+        freqs: Size of the frequency axis.
+        Others: As used for training; see est_cli.
+    """
+    layer_weights, logits_weights = read_weights(checkpoint, model_config,
+                                                 batchnorm)
+    with tf.Graph().as_default() as graph:
+        build_inference_graph(model_config, layer_weights, logits_weights,
+                              freqs, act, onedim, normalize, use_avg,
+                              data_format)
+        graph_def = graph.as_graph_def()
+
+    os.makedirs(export_dir, exist_ok=True)
+    with open(os.path.join(export_dir, GRAPH_FILE), mode="wb") as graph_file:
+        graph_file.write(graph_def.SerializeToString())
+    transform_entries = ["data_type", "frontend", "resample_rate",
+                         "window_size", "hop_length", "mel_freqs",
+                         "log_floor_db"]
+    inference_config = {
+        "checkpoint": checkpoint,
+        "input": INPUT_NAME + ":0",
+        "output": OUTPUT_NAME + ":0",
+        "freqs": freqs,
+        "threshold": threshold,
+        "data_config": {k: data_config_dict[k] for k in transform_entries
+                        if k in data_config_dict}}
+    with open(os.path.join(export_dir, CONFIG_FILE), mode="w") as config_file:
+        json.dump(inference_config, config_file, indent=2, sort_keys=True)
+    print("Exported {} to {}.".format(checkpoint, export_dir))
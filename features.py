@@ -0,0 +1,208 @@
+import librosa
+import numpy as np
+
+
+# at most this many samples (frames x window) go into one FFT call; numpy's
+# rfft works in float64/complex128, so this bounds its memory use to a few
+# hundred MB however many (or long) sequences are transformed at once
+FFT_CHUNK_SAMPLES = 2**22
+
+
+class FeatureExtractor:
+    """Computes log STFT magnitudes or log mel spectrograms with NumPy.
+
+    Window and mel filterbank are computed once. Batches of clips are
+    transformed with one FFT and (for mel) one matrix product over the frames
+    of many clips at once, in chunks of at most FFT_CHUNK_SAMPLES. Results
+    match data_utils.stft_transform/mel_transform (i.e. librosa with centered
+    frames, reflect padding and a periodic Hann window) up to float32
+    precision.
+
+    Instances are callable on a single clip, so they can be used wherever a
+    transformation function is expected (see data_utils.prepare_transform),
+    and they can be sent to worker processes.
+    """
+
+    def __init__(self, data_type, window_size, hop_length, sr=44100,
+                 mel_freqs=None, log_floor_db=None):
+        """
+        Parameters:
+            data_type: "stft" or "mel".
+            window_size: FFT size (and window length).
+            hop_length: Hop between frames.
+            sr: Sampling rate, for the mel filterbank.
+            mel_freqs: Number of mel bands; only for data_type "mel".
+            log_floor_db: If given, values are clipped to at most this many
+                          dB below the maximum of each clip (and magnitudes
+                          to amin before the log), so silent frames don't
+                          give -inf. Without it, results are exactly like
+                          librosa's.
+        """
+        if data_type not in ["stft", "mel"]:
+            raise ValueError("Invalid data_type {} for feature "
+                             "extraction.".format(data_type))
+        self.data_type = data_type
+        self.window_size = window_size
+        self.hop_length = hop_length
+        self.sr = sr
+        self.log_floor_db = log_floor_db
+        # stft gives amplitudes, mel gives power
+        db_scale = 20. if data_type == "stft" else 10.
+        self.amin = 1e-5 if data_type == "stft" else 1e-10
+        self.log_floor = None if log_floor_db is None else \
+            log_floor_db / db_scale * np.log(10.)
+        # periodic Hann window like scipy.signal.get_window("hann", n)
+        self.window = (0.5 - 0.5 * np.cos(
+            2 * np.pi * np.arange(window_size) / window_size)).astype(
+            np.float32)
+        if data_type == "mel":
+            # transposed to frames x fft bins -> frames x mels
+            self.mel_basis = librosa.filters.mel(
+                sr=sr, n_fft=window_size, n_mels=mel_freqs).T.astype(
+                np.float32)
+        else:
+            self.mel_basis = None
+
+    def __repr__(self):
+        return ("FeatureExtractor({}, {}, {}, sr={}, mel_freqs={}, "
+                "log_floor_db={})").format(
+            self.data_type, self.window_size, self.hop_length, self.sr,
+            None if self.mel_basis is None else self.n_features,
+            self.log_floor_db)
+
+    @property
+    def n_features(self):
+        """Size of the frequency axis of the output."""
+        if self.mel_basis is None:
+            return self.window_size // 2 + 1
+        return self.mel_basis.shape[1]
+
+    def __call__(self, seq):
+        """Transform a single 1D sequence; returns freqs x time."""
+        return self.transform_batch([seq])[0]
+
+    @property
+    def chunk_frames(self):
+        """Number of frames per FFT call, see FFT_CHUNK_SAMPLES."""
+        return max(1, FFT_CHUNK_SAMPLES // self.window_size)
+
+    def frames(self, seq, center=True):
+        """Windowed frames of a 1D sequence; frames x window.
+
+        If center is set, the sequence is padded like librosa does, so frame
+        t is centered at sample t * hop_length.
+        """
+        return self._frame_view(seq, center) * self.window
+
+    def _frame_view(self, seq, center=True):
+        """Like frames, but without the window, as a view (no copy) of the
+        (padded) sequence."""
+        padded = seq.astype(np.float32)
+        if center:
+            padded = np.pad(padded, self.window_size // 2, mode="reflect")
+        n_frames = max(
+            0, 1 + (len(padded) - self.window_size) // self.hop_length)
+        return np.lib.stride_tricks.as_strided(
+            padded, shape=(n_frames, self.window_size),
+            strides=(padded.strides[0] * self.hop_length, padded.strides[0]),
+            writeable=False)
+
+    def magnitudes(self, frames):
+        """Magnitudes (stft) or mel power of windowed frames, before the log.
+
+        Returns:
+            Array frames x freqs.
+        """
+        spectrum = np.empty((len(frames), self.n_features), dtype=np.float32)
+        for start in range(0, len(frames), self.chunk_frames):
+            chunk = np.abs(np.fft.rfft(
+                frames[start:start + self.chunk_frames], axis=1)).astype(
+                np.float32)
+            if self.mel_basis is not None:
+                chunk = np.dot(chunk ** 2, self.mel_basis)
+            spectrum[start:start + len(chunk)] = chunk
+        return spectrum
+
+    def log(self, spectrum):
+        """Log (with floor, if configured) of magnitudes for one clip.
+
+        Returns:
+            Array freqs x time.
+        """
+        if self.log_floor is None:
+            return np.log(spectrum).T
+        features = np.log(np.maximum(spectrum, self.amin))
+        return np.maximum(features, features.max() - self.log_floor).T
+
+    def transform_batch(self, seqs):
+        """Transform a list of 1D sequences (can have different lengths).
+
+        Frames of consecutive sequences are collected into chunks of
+        chunk_frames and windowed and transformed chunk by chunk, so besides
+        the results, memory use does not grow with the number or length of
+        the sequences.
+
+        Returns:
+            List of float32 arrays freqs x time, one per sequence.
+        """
+        views = [self._frame_view(seq) for seq in seqs]
+        spectra = [np.empty((len(view), self.n_features), dtype=np.float32)
+                   for view in views]
+        pending = []  # sequence index, first frame, frames
+        n_pending = 0
+
+        def flush():
+            magnitudes = self.magnitudes(
+                np.concatenate([part for _, _, part in pending]) *
+                self.window)
+            offset = 0
+            for ind, start, part in pending:
+                spectra[ind][start:start + len(part)] = \
+                    magnitudes[offset:offset + len(part)]
+                offset += len(part)
+            pending.clear()
+
+        for ind, view in enumerate(views):
+            start = 0
+            while start < len(view):
+                part = view[start:start + self.chunk_frames - n_pending]
+                pending.append((ind, start, part))
+                n_pending += len(part)
+                start += len(part)
+                if n_pending == self.chunk_frames:
+                    flush()
+                    n_pending = 0
+        if pending:
+            flush()
+        return [self.log(spectrum) for spectrum in spectra]
+
+
+class FeatureStream:
+    """Computes the frames of a FeatureExtractor incrementally.
+
+    Audio is pushed block by block; each call returns the magnitudes (see
+    FeatureExtractor.magnitudes) of all frames that are complete so far.
+    Concatenated, they are the same as for the whole signal at once (the
+    start is padded like librosa does, the end is not).
+    """
+
+    def __init__(self, extractor):
+        """
+        Parameters:
+            extractor: FeatureExtractor to use.
+        """
+        self.extractor = extractor
+        self._rest = None  # samples not used up by complete frames yet
+
+    def push(self, samples):
+        """Add a block of 1D audio; returns new frames x freqs."""
+        if self._rest is None:
+            self._rest = np.pad(samples.astype(np.float32),
+                                (self.extractor.window_size // 2, 0),
+                                mode="reflect")
+        else:
+            self._rest = np.concatenate([self._rest,
+                                         samples.astype(np.float32)])
+        frames = self.extractor.frames(self._rest, center=False)
+        self._rest = self._rest[len(frames) * self.extractor.hop_length:]
+        return self.extractor.magnitudes(frames)
@@ -1,6 +1,11 @@
+import collections
+import json
 import logging
+import os
+import time
 
 import tensorflow as tf
+from tensorflow.python.client import timeline
 
 
 class SummarySaverHookWithProfile(tf.train.SummarySaverHook):
@@ -9,15 +14,35 @@ class SummarySaverHookWithProfile(tf.train.SummarySaverHook):
     Use this instead of ProfilerHook, which just writes JSON files to disk you
     would have to look at some other way. This hook uses the Tensorboard
     profiling functionality instead.
+
+    Only the profiled steps are run with a full trace, so profiling costs
+    nothing in between. Each time the profile timer triggers, profile_window
+    consecutive steps are traced; at the end of the window, the time spent
+    per op type (summed over all ops, each counted once, and averaged over
+    the window; see _counted_devices) is printed. Optionally, Chrome traces
+    (view in chrome://tracing) of the steps and the op type breakdown are
+    also written to timeline_dir.
     """
 
     def __init__(self, save_steps=None, save_secs=None, profile_steps=None,
                  profile_secs=None, output_dir=None, summary_writer=None,
-                 scaffold=None, summary_op=None):
+                 scaffold=None, summary_op=None, profile_window=1,
+                 timeline_dir=None):
         super().__init__(save_steps, save_secs, output_dir, summary_writer,
                          scaffold, summary_op)
         self._profile_timer = tf.train.SecondOrStepTimer(
             every_secs=profile_secs, every_steps=profile_steps)
+        self._profile_window = max(profile_window, 1)
+        self._timeline_dir = timeline_dir
+        self._window_left = 0
+        self._op_micros = collections.Counter()
+
+    def begin(self):
+        super().begin()
+        self._op_types = {op.name: op.type
+                          for op in tf.get_default_graph().get_operations()}
+        if self._timeline_dir:
+            os.makedirs(self._timeline_dir, exist_ok=True)
 
     def before_run(self, run_context):
         self._request_summary = (
@@ -28,11 +53,14 @@ class SummarySaverHookWithProfile(tf.train.SummarySaverHook):
             if self._get_summary_op() is not None:
                 requests["summary"] = self._get_summary_op()
 
-        self._request_profile = (
+        self._start_profile = not self._window_left and (
             self._next_step is None or
             self._profile_timer.should_trigger_for_step(self._next_step))
+        if self._start_profile:
+            self._window_left = self._profile_window
+        self._request_profile = self._window_left > 0
         opts = (tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-                if self._request_summary else None)
+                if self._request_profile else None)
 
         return tf.train.SessionRunArgs(requests, options=opts)
 
@@ -57,9 +85,157 @@ class SummarySaverHookWithProfile(tf.train.SummarySaverHook):
                     self._summary_writer.add_summary(summary, global_step)
 
         if self._request_profile:
-            self._profile_timer.update_last_triggered_step(global_step)
-            self._summary_writer.add_run_metadata(run_values.run_metadata,
-                                                  "step{}".format(global_step),
-                                                  global_step=global_step)
-            print("Added profiling for step {}.".format(global_step))
+            if self._start_profile:
+                self._profile_timer.update_last_triggered_step(global_step)
+            self._add_profile(run_values.run_metadata, global_step)
         self._next_step = global_step + 1
+
+    def _add_profile(self, run_metadata, global_step):
+        self._summary_writer.add_run_metadata(run_metadata,
+                                              "step{}".format(global_step),
+                                              global_step=global_step)
+        print("Added profiling for step {}.".format(global_step))
+        step_stats = run_metadata.step_stats
+        for device in self._counted_devices(step_stats):
+            for node in device.node_stats:
+                op_type = self._op_types.get(node.node_name.split(":")[0],
+                                             node.node_name)
+                self._op_micros[op_type] += node.all_end_rel_micros
+        if self._timeline_dir:
+            trace = timeline.Timeline(
+                step_stats).generate_chrome_trace_format()
+            with open(os.path.join(self._timeline_dir,
+                                   "timeline-{}.json".format(global_step)),
+                      mode="w") as trace_file:
+                trace_file.write(trace)
+
+        self._window_left -= 1
+        if not self._window_left:
+            self._report_op_types(global_step)
+            self._op_micros.clear()
+
+    @staticmethod
+    def _counted_devices(step_stats):
+        """Device stats that list each op's time once.
+
+        With a full trace on GPU, kernels are reported under the GPU device
+        itself, under its stream:all pseudo-device and under each stream (and
+        copies under memcpy). If stream:all is there, only it is used for
+        the GPUs; CPU devices are always used.
+        """
+        devices = list(step_stats.dev_stats)
+        if not any(device.device.endswith("/stream:all")
+                   for device in devices):
+            return devices
+        return [device for device in devices
+                if device.device.endswith("/stream:all") or
+                "gpu:" not in device.device.lower()]
+
+    def _report_op_types(self, global_step, top=15):
+        total = sum(self._op_micros.values()) or 1
+        breakdown = [(op_type, micros / 1000 / self._profile_window,
+                      micros / total)
+                     for op_type, micros in self._op_micros.most_common()]
+        print("Op time per step by type, over {} step(s) up to step "
+              "{}:".format(self._profile_window, global_step))
+        for op_type, ms, share in breakdown[:top]:
+            print("    {:30s} {:10.2f}ms {:6.1%}".format(op_type, ms, share))
+        if self._timeline_dir:
+            with open(os.path.join(self._timeline_dir,
+                                   "op_types-{}.json".format(global_step)),
+                      mode="w") as breakdown_file:
+                json.dump([{"op_type": op_type, "ms_per_step": ms,
+                            "share": share}
+                           for op_type, ms, share in breakdown],
+                          breakdown_file, indent=2)
+
+
+class InputStallHook(tf.train.SessionRunHook):
+    """Measures how much of each training step is spent waiting for input.
+
+    Every trace_steps steps, the step is run with a software trace, which
+    gives the time spent in the iterator's get_next op(s). The rest of the
+    step is counted as compute. A step where get_next returns (almost)
+    immediately found its batch ready in the prefetch buffer; the share of
+    such steps is reported as prefetch occupancy. Averages over the traced
+    steps are written as summaries and logged every every_n_steps steps.
+    """
+
+    def __init__(self, every_n_steps=100, trace_steps=10, output_dir=None,
+                 ready_ms=1.):
+        """
+        Parameters:
+            every_n_steps: How often to write/log the averages.
+            trace_steps: How often to trace a step. Tracing is cheap, but not
+                         free.
+            output_dir: Where to write summaries to. If None, only log.
+            ready_ms: get_next calls faster than this count as finding the
+                      batch ready.
+        """
+        self._every_n_steps = every_n_steps
+        self._trace_steps = trace_steps
+        self._output_dir = output_dir
+        self._ready_ms = ready_ms
+        self._step = 0
+        self._reset()
+
+    def begin(self):
+        self._get_next_names = {
+            op.name for op in tf.get_default_graph().get_operations()
+            if op.type in ["IteratorGetNext", "IteratorGetNextSync"]}
+        if not self._get_next_names:
+            tf.logging.warning("InputStallHook: No iterator found in the "
+                               "graph.")
+        self._global_step_tensor = tf.train.get_global_step()
+        self._writer = (tf.summary.FileWriterCache.get(self._output_dir)
+                        if self._output_dir else None)
+
+    def before_run(self, run_context):
+        self._trace = self._step % self._trace_steps == 0
+        self._start = time.time()
+        opts = (tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE)
+                if self._trace else None)
+        return tf.train.SessionRunArgs(self._global_step_tensor, options=opts)
+
+    def after_run(self, run_context, run_values):
+        step_ms = (time.time() - self._start) * 1000
+        self._step += 1
+        if self._trace:
+            wait_ms = sum(
+                node.all_end_rel_micros / 1000
+                for device in run_values.run_metadata.step_stats.dev_stats
+                for node in device.node_stats
+                if node.node_name in self._get_next_names)
+            self._n_traced += 1
+            self._step_ms += step_ms
+            self._wait_ms += wait_ms
+            self._n_ready += wait_ms < self._ready_ms
+
+        if self._step % self._every_n_steps == 0 and self._n_traced:
+            self._report(run_values.results)
+            self._reset()
+
+    def _report(self, global_step):
+        step_ms = self._step_ms / self._n_traced
+        wait_ms = self._wait_ms / self._n_traced
+        values = {"input_stall/step_ms": step_ms,
+                  "input_stall/get_next_ms": wait_ms,
+                  "input_stall/compute_ms": step_ms - wait_ms,
+                  "input_stall/input_fraction": wait_ms / max(step_ms, 1e-9),
+                  "input_stall/prefetch_occupancy":
+                      self._n_ready / self._n_traced}
+        if self._writer:
+            self._writer.add_summary(tf.Summary(value=[
+                tf.Summary.Value(tag=tag, simple_value=value)
+                for tag, value in values.items()]), global_step)
+        tf.logging.info(
+            "Step %d: %.1f ms per step, %.1f ms waiting for input (%.0f%%), "
+            "batch ready in %.0f%% of steps.", global_step, step_ms, wait_ms,
+            100 * values["input_stall/input_fraction"],
+            100 * values["input_stall/prefetch_occupancy"])
+
+    def _reset(self):
+        self._n_traced = 0
+        self._n_ready = 0
+        self._step_ms = 0.
+        self._wait_ms = 0.
@@ -1,146 +1,461 @@
 import argparse
+import glob
+import hashlib
+import json
 import os
+import shutil
 import sys
 
-import librosa
 import numpy as np
 import tensorflow as tf
 
-from data_utils import make_dev_inds, make_labeled_data_list, \
-    prepare_transform, read_data_config, random_pad
+from audio_cache import cache_from_config
+from augment import AugmentationPool
+from data_utils import DEFAULT_RECORD_FORMAT, RECORD_VERSIONS, \
+    dev_inds_of, file_id, file_key, find_tfrecords, index_path, \
+    load_dev_set, make_labeled_data_list, manifest_path, prepare_transform, \
+    process_data_list, read_data_config, read_durations, read_index, \
+    read_manifest, read_skipped, skipped_path, tfrecord_path, write_index, \
+    write_manifest, write_skipped
 
 
-def fulfill_config(config_path):
-    """Checks whether the data for a requested config exists and creates it otherwise."""
+# input files (or augmented examples) per chunk of make_tfrecords
+CHUNK_SIZE = 500
+JOURNAL_FILE = "progress.json"
+
+
+def fulfill_config(config_path, n_workers=1, update=False):
+    """Checks whether the data for a requested config exists and creates it otherwise.
+
+    Parameters:
+        config_path: Path to a data config file.
+        n_workers: Number of processes to use for loading/transforming the
+                   data. 1 means everything happens in this process.
+        update: If set, the data has to exist already; files that are
+                missing from it are added (see update_tfrecords).
+    """
     config_dict = read_data_config(config_path)
+    if update:
+        update_tfrecords(config_dict, n_workers)
+        return
+
+    train_exists = bool(find_tfrecords(config_dict["tfr_path"], "train"))
+    dev_exists = bool(find_tfrecords(config_dict["tfr_path"], "dev"))
+    if os.path.exists(chunk_dir(config_dict["tfr_path"])):
+        print("Found unfinished TFRecords creation. Continuing...")
+        create_tfrecords(config_dict, n_workers)
 
-    train_path = config_dict["tfr_path"] + "_train.tfrecords"
-    dev_path = config_dict["tfr_path"] + "_dev.tfrecords"
-    if not os.path.exists(train_path) and not os.path.exists(dev_path):
+    elif not train_exists and not dev_exists:
         create_data_dir = input("The requested TFRecords files do not seem to "
                                 "exist. Do you want to create them? This "
-                                "could take a very long time. Type y/n (no "
+                                "could take a very long time (but can be "
+                                "resumed if interrupted). Type y/n (no "
                                 "exits the program):")
 
         if create_data_dir.lower()[0] == "y":
-            data_list = make_labeled_data_list(
-                config_dict["data_dir"], config_dict["datasets"],
-                config_dict["n_max"])
-            transform = prepare_transform(config_dict)
-
-            if not os.path.exists(config_dict["dev_inds"]):
-                print("No dev inds found at specified path. Creating them...")
-                make_dev_inds(data_list, 0.85, config_dict["dev_inds"])
-
-            make_tfrecords(data_list, config_dict["tfr_path"],
-                           dev_inds=np.load(config_dict["dev_inds"]),
-                           resample_rate=config_dict["resample_rate"],
-                           n_augment=config_dict["n_augment"],
-                           transform=transform)
+            create_tfrecords(config_dict, n_workers)
 
         else:
             sys.exit("TFRecords file does not exist and creation not "
                      "requested.")
 
-    elif not os.path.exists(train_path) or not os.path.exists(dev_path):
+    elif not train_exists or not dev_exists:
         sys.exit("Either only training or dev file already exists. This is not"
                  " intended!")
 
 
+def create_tfrecords(config_dict, n_workers=1):
+    """Run make_tfrecords with the settings from a data config."""
+    data_list = make_labeled_data_list(
+        config_dict["data_dir"], config_dict["datasets"],
+        config_dict["n_max"])
+    dev_keys, _ = load_dev_set(config_dict["dev_inds"], data_list)
+    make_tfrecords(data_list, config_dict["tfr_path"],
+                   dev_inds=dev_inds_of(data_list, dev_keys),
+                   n_augment=config_dict["n_augment"],
+                   **_make_args(config_dict, n_workers))
+
+
+def update_tfrecords(config_dict, n_workers=1):
+    """Add files that are not in the TFRecords yet, e.g. a new dataset.
+
+    Only the new files are processed; they go into additional files
+    (<tfr_path>_updateXX_...) that are added to the manifest, which is
+    created if the data wasn't sharded before. Existing files are left
+    alone. New files are assigned to the dev set as described in
+    data_utils.load_dev_set. No augmented data is created for them.
+    Interrupted updates are continued when running this again.
+
+    Files that were left out before (too long or unreadable, see
+    data_utils.read_skipped) don't count as new. To retry them, remove them
+    from the list.
+
+    Parameters:
+        config_dict: Data config; datasets may include new ones.
+        n_workers: See fulfill_config.
+    """
+    tfr_path = config_dict["tfr_path"]
+    existing = read_manifest(tfr_path)
+    index = read_index([path for subset in ["train", "dev"]
+                        for path in existing.get(subset, {"files": []})[
+                            "files"]])
+    if index is None:
+        raise ValueError("Updating needs the indices of the existing "
+                         "TFRecords. Please recreate the data.")
+    done_ids = set(index["id"])
+    skipped = read_skipped(tfr_path)
+
+    data_list = make_labeled_data_list(
+        config_dict["data_dir"], config_dict["datasets"],
+        config_dict["n_max"])
+    dev_keys, _ = load_dev_set(config_dict["dev_inds"], data_list)
+    new_list = [(filename, label) for filename, label in data_list
+                if file_id(filename) not in done_ids and
+                file_key(filename) not in skipped]
+    if not new_list:
+        print("Nothing to update.")
+        return
+    print("Found {} new files.".format(len(new_list)))
+
+    update = 1
+    while True:  # first update that's unused or unfinished
+        update_path = "{}_update{:02d}".format(tfr_path, update)
+        if os.path.exists(chunk_dir(update_path)) or \
+                not glob.glob(update_path + "_*"):
+            break
+        update += 1
+    written = make_tfrecords(new_list, update_path,
+                             dev_inds=dev_inds_of(new_list, dev_keys),
+                             **_make_args(config_dict, n_workers))
+    if os.path.exists(manifest_path(update_path)):
+        os.remove(manifest_path(update_path))
+    new_skipped = read_skipped(update_path)
+    if new_skipped:
+        write_skipped(tfr_path, skipped.union(new_skipped))
+    os.remove(skipped_path(update_path))
+
+    if not any(entry["n_examples"] for entry in written.values()):
+        # don't keep (or list) empty files
+        for entry in written.values():
+            for path in entry["files"]:
+                os.remove(path)
+                os.remove(index_path(path))
+        print("None of the new files could be used.")
+        return
+
+    for subset, entry in written.items():
+        merged = existing.setdefault(subset, {"files": [], "n_examples": 0})
+        merged["files"] += entry["files"]
+        if merged["n_examples"] is not None:
+            merged["n_examples"] += entry["n_examples"]
+    write_manifest(tfr_path, existing)
+    print("Added {} train and {} dev examples.".format(
+        written["train"]["n_examples"], written["dev"]["n_examples"]))
+
+
+def _make_args(config_dict, n_workers):
+    """Arguments for make_tfrecords from a data config."""
+    return {"resample_rate": config_dict["resample_rate"],
+            "transform": prepare_transform(config_dict),
+            "n_workers": n_workers,
+            "n_shards": config_dict["n_shards"] or 1,
+            "record_format": (config_dict["record_format"] or
+                              DEFAULT_RECORD_FORMAT),
+            "cache": cache_from_config(config_dict),
+            "durations": (read_durations(config_dict["durations"])
+                          if config_dict["durations"] else None)}
+
+
 def make_tfrecords(data_list, out_path, dev_inds, resample_rate=None,
-                   n_augment=0, transform=None):
+                   n_augment=0, transform=None, n_workers=1, n_shards=1,
+                   record_format=DEFAULT_RECORD_FORMAT, cache=None,
+                   durations=None, chunk_size=CHUNK_SIZE, seed=0):
     """Consume an iterator and put everything into .tfrecords files.
 
+    The data is first written in chunks to a work directory next to out_path
+    (see chunk_dir), with a journal of the finished chunks. If this is
+    interrupted, calling it again with the same arguments continues with the
+    first unfinished chunk. Once all chunks are there, they are copied to the
+    final files in order and the work directory is removed. Since every chunk
+    comes out the same regardless of when it is written, the result is the
+    same as for an uninterrupted run.
+
     Parameters:
         data_list: Should return pairs of filename, label.
         out_path: Base path to store the resulting files to.
-        dev_inds: np.array of ints. These will be taken as indices for the
-                  heldout set.*
+        dev_inds: Indices into data_list for the heldout set; see
+                  data_utils.load_dev_set.
         resample_rate: Optional int giving the Hz to resample the data to.
         n_augment: Number of extra sequences to generate by mixing existing 
-                   ones.
+                   training ones (see augment.AugmentationPool).
         transform: Transformation function to apply to the raw sequences. If
                    None, nothing is applied. This will only receive a sequence
                    as input, so prepare it accordingly beforehand.
+        n_workers: If > 1, load and transform the regular data in this many
+                   worker processes. Results are still written in order, so
+                   the output is the same as with a single process.
+        n_shards: Number of files to split each subset into. Examples are
+                  distributed round-robin. If > 1, a manifest listing all
+                  files is written as well.
+        record_format: How to store the sequences. See
+                       data_utils.read_data_config.
+        cache: Optional AudioCache to read the audio files through.
+        durations: Optional dict file key -> (duration, sr), see
+                   data_utils.read_durations. Files listed there as too long
+                   are skipped without loading them.
+        chunk_size: Number of input files (or augmented examples) per chunk.
+        seed: Augmented examples of chunk c are created with random seed
+              (seed, c).
+
+    Returns:
+        Dict subset -> {"files": list of paths, "n_examples": int}, as for
+        data_utils.write_manifest. Files that were left out (too long or
+        unreadable) are listed next to the TFRecords, see
+        data_utils.read_skipped.
     """
-    def serialize(_seq, _label, writer):
-        tfex = tf.train.Example(features=tf.train.Features(
-            feature={"seq": tf.train.Feature(
-                float_list=tf.train.FloatList(value=_seq.flatten())),
-                "shape": tf.train.Feature(
-                    int64_list=tf.train.Int64List(value=_seq.shape)),
-                "label": tf.train.Feature(
-                    int64_list=tf.train.Int64List(value=[_label]))}))
-        writer.write(tfex.SerializeToString())
-
-    dev_inds = set(dev_inds)
-    with tf.python_io.TFRecordWriter(
-                    out_path + "_train.tfrecords") as train_writer, \
-            tf.python_io.TFRecordWriter(
-                        out_path + "_dev.tfrecords") as dev_writer:
-        for ind, (filename, label) in enumerate(data_list):
-            seq, sr = librosa.load(filename, sr=resample_rate)
-            if len(seq) / sr > 20:  # skip sequences > 20 seconds
-                continue
-            if transform:
-                seq = transform(seq)
-            else:  # raw: Add fake channel axis
-                seq = seq[None, :]
-
-            if ind in dev_inds:
-                serialize(seq, label, dev_writer)
-            else:
-                serialize(seq, label, train_writer)
-            if (ind + 1) % 100 == 0:
-                print("Processed {} sequences!".format(ind+1))
-    print("All done!")
+    dev_inds = set(int(ind) for ind in dev_inds)
+    work_dir = chunk_dir(out_path)
+    journal = ProgressJournal(work_dir, {
+        "n_files": len(data_list),
+        "dev_inds": hashlib.sha1(
+            str(sorted(dev_inds)).encode()).hexdigest(),
+        "n_augment": n_augment or 0,
+        "resample_rate": resample_rate,
+        "transform": repr(transform),
+        "record_format": record_format,
+        "chunk_size": chunk_size,
+        "seed": seed})
 
-    if n_augment:
-        print("Augmenting with {} examples...".format(n_augment))
-        # first some preparations...
-        all_inds = np.arange(len(data_list))
-        valid_inds = np.delete(all_inds, dev_inds)
-        bird_files = [file for ind, (file, label) in enumerate(data_list)
-                      if ind in valid_inds and label]
-        noise_files = [file for ind, (file, label) in enumerate(data_list)
-                       if ind in valid_inds and not label]
-
-        prop_birds = len(bird_files) / (len(bird_files) + len(noise_files))
-        p_pick_birds = 1 - np.sqrt(1 - prop_birds)
-
-        with tf.python_io.TFRecordWriter(
-                        out_path + "_augment.tfrecords") as aug_writer:
-            for ind in range(n_augment):
-                has_bird = False
-                if np.random.rand() < p_pick_birds:
-                    f1 = np.random.choice(bird_files)
-                    has_bird = True
-                else:
-                    f1 = np.random.choice(noise_files)
-                if np.random.rand() < p_pick_birds:
-                    f2 = np.random.choice(bird_files)
-                    has_bird = True
-                else:
-                    f2 = np.random.choice(noise_files)
-                seq1, sr = librosa.load(f1, sr=resample_rate)
-                seq2, sr = librosa.load(f2, sr=resample_rate)
-
-                if len(seq1) / sr > 20 or len(seq2) / sr > 20:
+    n_chunks = -(-len(data_list) // chunk_size)
+    todo = [chunk for chunk in range(n_chunks)
+            if not journal.is_done("regular", chunk)]
+    if len(todo) < n_chunks:
+        print("Resuming: {} of {} chunks already done.".format(
+            n_chunks - len(todo), n_chunks))
+    todo_inds = [ind for chunk in todo
+                 for ind in range(chunk * chunk_size,
+                                  min((chunk + 1) * chunk_size,
+                                      len(data_list)))]
+    processed = process_data_list([data_list[ind] for ind in todo_inds],
+                                  resample_rate, transform, n_workers, cache,
+                                  durations=durations)
+    for chunk in todo:
+        chunk_path = os.path.join(work_dir, "regular-{:05d}".format(chunk))
+        with ShardedWriter(chunk_path, "train") as train_writer, \
+                ShardedWriter(chunk_path, "dev") as dev_writer:
+            for ind in range(chunk * chunk_size,
+                             min((chunk + 1) * chunk_size, len(data_list))):
+                result = next(processed)
+                if result is None:  # skipped or broken
                     continue
+                seq, duration = result
+                filename, label = data_list[ind]
+                writer = dev_writer if ind in dev_inds else train_writer
+                writer.write(make_example(seq, label, record_format,
+                                          file_id(filename)),
+                             (file_id(filename), filename, label, seq.shape,
+                              duration))
+        journal.mark_done("regular", chunk)
+        print("Processed {} sequences!".format(
+            min((chunk + 1) * chunk_size, len(data_list))))
+
+    n_aug_chunks = -(-(n_augment or 0) // chunk_size)
+    todo = [chunk for chunk in range(n_aug_chunks)
+            if not journal.is_done("augment", chunk)]
+    if todo:
+        print("Augmenting with {} examples...".format(n_augment))
+        train_inds = [ind for ind in range(len(data_list))
+                      if ind not in dev_inds]
+        pool = AugmentationPool.from_data_list(
+            data_list, train_inds, resample_rate=resample_rate,
+            transform=transform, cache=cache, n_workers=n_workers)
+        for chunk in todo:
+            chunk_path = os.path.join(work_dir, "augment-{:05d}".format(chunk))
+            n_chunk = min(chunk_size, n_augment - chunk * chunk_size)
+            with ShardedWriter(chunk_path, "augment") as aug_writer:
+                for seq, label, sources, duration in pool.generate(
+                        n_chunk, rng=np.random.RandomState([seed, chunk])):
+                    aug_writer.write(make_example(seq, label, record_format),
+                                     (-1, sources, label, seq.shape,
+                                      duration))
+            journal.mark_done("augment", chunk)
+            print("Generated {} sequences!".format(chunk * chunk_size +
+                                                   n_chunk))
+
+    print("Writing final files...")
+    written = []
+    written_ids = set()
+    for subset, kind, n in [("train", "regular", n_chunks),
+                            ("dev", "regular", n_chunks),
+                            ("augment", "augment", n_aug_chunks)]:
+        if not n:
+            continue
+        with ShardedWriter(out_path, subset, n_shards) as writer:
+            for chunk in range(n):
+                chunk_file = tfrecord_path(os.path.join(
+                    work_dir, "{}-{:05d}".format(kind, chunk)), subset)
+                for record, row in zip(
+                        tf.python_io.tf_record_iterator(chunk_file),
+                        np.load(index_path(chunk_file))):
+                    writer.write(record, (int(row["id"]), str(row["file"]),
+                                          int(row["label"]),
+                                          tuple(row["shape"]),
+                                          float(row["duration"])))
+                    written_ids.add(int(row["id"]))
+        written.append(writer)
+    write_skipped(out_path, [file_key(filename) for filename, _ in data_list
+                             if file_id(filename) not in written_ids])
+
+    subsets = {w.subset: {"files": w.paths, "n_examples": w.n_written}
+               for w in written}
+    if n_shards > 1:
+        write_manifest(out_path, subsets)
+    shutil.rmtree(work_dir)
+    print("All done!")
+    return subsets
+
+
+def chunk_dir(out_path):
+    """Work directory of make_tfrecords. Only exists while unfinished."""
+    return out_path + "_chunks"
+
+
+class ProgressJournal:
+    """Records which chunks of make_tfrecords are finished.
+
+    The journal is a json file in the work directory, rewritten atomically
+    after each chunk. It also holds the settings of the run, so chunks from a
+    run with different settings are never mixed in.
+    """
+
+    def __init__(self, work_dir, settings):
+        """
+        Parameters:
+            work_dir: Work directory; created if it doesn't exist.
+            settings: Dict of json-compatible values describing the run.
+        """
+        self.path = os.path.join(work_dir, JOURNAL_FILE)
+        os.makedirs(work_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path) as journal_file:
+                journal = json.load(journal_file)
+            if journal["settings"] != settings:
+                raise ValueError(
+                    "Unfinished TFRecords creation with different settings "
+                    "found in {}. Remove it to start over.".format(work_dir))
+            self.done = journal["done"]
+        else:
+            self.done = {"regular": [], "augment": []}
+        self.settings = settings
+        self._save()
+
+    def is_done(self, kind, chunk):
+        return chunk in self.done[kind]
+
+    def mark_done(self, kind, chunk):
+        self.done[kind].append(chunk)
+        self._save()
+
+    def _save(self):
+        with open(self.path + ".tmp", mode="w") as journal_file:
+            json.dump({"settings": self.settings, "done": self.done},
+                      journal_file)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def make_example(seq, label, record_format=DEFAULT_RECORD_FORMAT,
+                 example_id=-1):
+    """Serialize a sequence and its label to a tf.train.Example string.
+
+    Parameters:
+        seq: 2D numpy array.
+        label: int.
+        record_format: One of data_utils.RECORD_VERSIONS. The corresponding
+                       version number is stored with the example.
+        example_id: int to identify the example, see data_utils.file_id.
+
+    Returns:
+        The serialized example.
+    """
+    version = RECORD_VERSIONS[record_format]
+    if record_format == "float_list":
+        seq_feature = {"seq": tf.train.Feature(
+            float_list=tf.train.FloatList(value=seq.flatten()))}
+    else:  # raw little-endian bytes
+        dtype = "<f2" if record_format == "float16" else "<f4"
+        seq_feature = {"seq_bytes": tf.train.Feature(
+            bytes_list=tf.train.BytesList(
+                value=[np.ascontiguousarray(seq, dtype=dtype).tobytes()]))}
+    tfex = tf.train.Example(features=tf.train.Features(
+        feature=dict(seq_feature,
+                     shape=tf.train.Feature(
+                         int64_list=tf.train.Int64List(value=seq.shape)),
+                     label=tf.train.Feature(
+                         int64_list=tf.train.Int64List(value=[label])),
+                     version=tf.train.Feature(
+                         int64_list=tf.train.Int64List(value=[version])),
+                     id=tf.train.Feature(
+                         int64_list=tf.train.Int64List(value=[example_id])))))
+    return tfex.SerializeToString()
+
+
+class ShardedWriter:
+    """Distributes records round-robin over one or more TFRecords files.
+
+    Can be used like a single TFRecordWriter, including as context manager.
+    On closing, an index (see data_utils.index_dtype) is written next to each
+    file, unless the context is left because of an exception.
+    """
+
+    def __init__(self, out_path, subset, n_shards=1):
+        """
+        Parameters:
+            out_path: Base path to store the files to.
+            subset: Name of the subset (train, dev, augment).
+            n_shards: Number of files to write.
+        """
+        self.subset = subset
+        self.paths = [tfrecord_path(out_path, subset, shard, n_shards)
+                      for shard in range(n_shards)]
+        self.n_written = 0
+        self._writers = [tf.python_io.TFRecordWriter(path)
+                         for path in self.paths]
+        self._offsets = [0] * n_shards
+        self._index_rows = [[] for _ in range(n_shards)]
+
+    def write(self, record, info=(-1, "", -1, (0, 0), np.nan)):
+        """Write a record.
+
+        Parameters:
+            record: Serialized example.
+            info: Tuple id, source file, label, shape, duration for the index.
+        """
+        shard = self.n_written % len(self._writers)
+        self._writers[shard].write(record)
+        self._index_rows[shard].append((self._offsets[shard],) + tuple(info))
+        # each record is framed by its length (8 bytes) and two checksums
+        self._offsets[shard] += len(record) + 16
+        self.n_written += 1
+
+    def close(self, write_indices=True):
+        """Close all files.
 
-                longer = max(len(seq1), len(seq2))
-                seq1 = random_pad(seq1, longer)
-                seq2 = random_pad(seq2, longer)
-                mixed_seq = 0.5 * (seq1 + seq2)
+        Parameters:
+            write_indices: If false, no indices are written, e.g. because
+                           the files are incomplete.
+        """
+        for writer, path, rows in zip(self._writers, self.paths,
+                                      self._index_rows):
+            writer.close()
+            if write_indices:
+                write_index(path, rows)
 
-                if transform:
-                    seq = transform(mixed_seq)
-                else:  # raw: Add fake freq axis
-                    seq = mixed_seq[None, :]
-                serialize(seq, int(has_bird), aug_writer)
+    def __enter__(self):
+        return self
 
-                if (ind + 1) % 100 == 0:
-                    print("Generated {} sequences!".format(ind+1))
+    def __exit__(self, exc_type, *_):
+        # an index would claim that a partial file is complete
+        self.close(write_indices=exc_type is None)
 
 
 if __name__ == "__main__":
@@ -148,5 +463,17 @@ if __name__ == "__main__":
         description="Build a TFRecords file for a given data config.")
     parser.add_argument("config_path",
                         help="Path to a data config file.")
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes to use for loading and "
+                             "transforming the data. Default: 1.")
+    parser.add_argument("-u", "--update",
+                        action="store_true",
+                        help="Add files that are not in the existing "
+                             "TFRecords yet (e.g. after adding a dataset to "
+                             "the config) as additional files, instead of "
+                             "creating everything.")
     args = parser.parse_args()
-    fulfill_config(args.config_path)
+    fulfill_config(args.config_path, n_workers=args.workers,
+                   update=args.update)
@@ -0,0 +1,129 @@
+# long-lived scoring process for models exported with est_cli export
+import argparse
+import json
+import os
+import socketserver
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_utils import prepare_frontend, prepare_transform, process_file
+from export import CONFIG_FILE, GRAPH_FILE
+
+
+class Scorer:
+    """Loads an exported model once and scores batches of audio files."""
+
+    def __init__(self, export_dir):
+        """
+        Parameters:
+            export_dir: Folder written by export.export_model.
+        """
+        with open(os.path.join(export_dir, CONFIG_FILE)) as config_file:
+            self.config = json.load(config_file)
+        # the graph takes features, so a frontend is applied in numpy here
+        self.transform = prepare_transform(self.config["data_config"]) or \
+            prepare_frontend(self.config["data_config"])
+
+        graph_def = tf.GraphDef()
+        with open(os.path.join(export_dir, GRAPH_FILE), mode="rb") as \
+                graph_file:
+            graph_def.ParseFromString(graph_file.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.inputs = self.graph.get_tensor_by_name(self.config["input"])
+        self.outputs = self.graph.get_tensor_by_name(self.config["output"])
+        self.session = tf.Session(graph=self.graph)
+
+    def prepare(self, filename):
+        """Load and transform a file; None if that fails."""
+        result = process_file(
+            filename, self.config["data_config"]["resample_rate"],
+            self.transform, max_seconds=None)
+        if result is None:
+            return None
+        seq = result[0].astype(np.float32)
+        if self.config["threshold"]:  # same as est_input.apply_threshold
+            seq = np.maximum(seq, seq.max() - 8.*np.log(10.))
+        return seq
+
+    def score(self, seqs):
+        """Score a list of 2D sequences freqs x time (padded as a batch).
+
+        Returns:
+            Array of probabilities.
+        """
+        batch = np.zeros((len(seqs), 1, self.config["freqs"],
+                          max(seq.shape[-1] for seq in seqs)),
+                         dtype=np.float32)
+        for ind, seq in enumerate(seqs):
+            batch[ind, 0, :, :seq.shape[-1]] = seq
+        return self.session.run(self.outputs,
+                                feed_dict={self.inputs: batch})[:, 0]
+
+    def handle(self, request):
+        """Answer a request {"files": [...]} with the probability per file.
+
+        Files that can't be read get null.
+        """
+        start = time.time()
+        seqs = [self.prepare(filename) for filename in request["files"]]
+        valid = [seq for seq in seqs if seq is not None]
+        probs = iter(self.score(valid) if valid else [])
+        return {"files": request["files"],
+                "probabilities": [None if seq is None else float(next(probs))
+                                  for seq in seqs],
+                "seconds": time.time() - start}
+
+
+def serve_lines(scorer, lines_in, write):
+    """Answer one json request per line until the input ends."""
+    for line in lines_in:
+        if not line.strip():
+            continue
+        try:
+            response = scorer.handle(json.loads(line))
+        except Exception as err:  # bad requests shouldn't kill the server
+            response = {"error": str(err)}
+        write(json.dumps(response) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score audio files with an exported model. Requests are "
+                    "json lines like {\"files\": [\"a.wav\", \"b.wav\"]}, "
+                    "answered by one json line each.")
+    parser.add_argument("export_dir",
+                        help="Folder with the exported model (est_cli "
+                             "export).")
+    parser.add_argument("-p", "--port",
+                        type=int,
+                        help="Listen on this port on localhost instead of "
+                             "reading requests from stdin.")
+    args = parser.parse_args()
+
+    SCORER = Scorer(args.export_dir)
+    print("Model loaded.", file=sys.stderr)
+
+    if args.port:
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                serve_lines(SCORER, (line.decode() for line in self.rfile),
+                            lambda text: self.wfile.write(text.encode()))
+
+        with socketserver.TCPServer(("localhost", args.port), Handler) as \
+                server:
+            print("Listening on localhost:{}".format(args.port))
+            server.serve_forever()
+    else:
+        # keep stdout for responses only; any other output goes to stderr
+        RESPONSES = sys.stdout
+        sys.stdout = sys.stderr
+
+        def write_flush(text):
+            RESPONSES.write(text)
+            RESPONSES.flush()
+        serve_lines(SCORER, sys.stdin, write_flush)
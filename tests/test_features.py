@@ -0,0 +1,28 @@
+import numpy as np
+
+from data_utils import mel_transform, stft_transform
+from features import FeatureExtractor
+
+
+SR = 8000
+
+
+def random_signal(seconds=0.5):
+    return np.random.RandomState(0).uniform(
+        -0.5, 0.5, int(seconds * SR)).astype(np.float32)
+
+
+def test_stft_matches_reference():
+    seq = random_signal()
+    extractor = FeatureExtractor("stft", 256, 64, sr=SR)
+    expected = stft_transform(seq, 256, 64)
+    assert extractor(seq).shape == expected.shape
+    np.testing.assert_allclose(extractor(seq), expected, rtol=1e-3, atol=1e-3)
+
+
+def test_mel_matches_reference():
+    seq = random_signal()
+    extractor = FeatureExtractor("mel", 256, 64, sr=SR, mel_freqs=40)
+    expected = mel_transform(seq, SR, 256, 64, 40)
+    assert extractor(seq).shape == expected.shape
+    np.testing.assert_allclose(extractor(seq), expected, rtol=1e-3, atol=1e-3)
@@ -0,0 +1,70 @@
+import os
+import runpy
+import subprocess
+import sys
+
+import numpy as np
+import soundfile
+import tensorflow as tf
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SR = 8000
+FREQS = 33  # window_size // 2 + 1
+
+
+def write_configs(base_path):
+    """Tiny stft data config and model config; returns their paths."""
+    data_config = os.path.join(base_path, "data_config")
+    with open(data_config, mode="w") as config_file:
+        config_file.write("\n".join([
+            "tfr_path,{}".format(os.path.join(base_path, "records")),
+            "data_dir,{}".format(base_path),
+            "datasets,freefield",
+            "data_type,stft",
+            "window_size,64",
+            "hop_length,32",
+            "dev_inds,{}".format(os.path.join(base_path, "dev_inds.npy"))]))
+    model_config = os.path.join(base_path, "model_config")
+    with open(model_config, mode="w") as config_file:
+        config_file.write("layer,4,3,1\npool,1,2,2\nlayer,4,3,1")
+    return data_config, model_config
+
+
+def est_cli_args(mode, data_config, model_config, model_dir):
+    return [mode, data_config, model_config, model_dir, "-F", "channels_last",
+            "-V", "0", "-B", "4"]
+
+
+def test_infer_with_several_workers(tmp_path, monkeypatch):
+    data_config, model_config = write_configs(str(tmp_path))
+    model_dir = str(tmp_path / "model")
+    wav_dir = tmp_path / "wavs"
+    wav_dir.mkdir()
+    for ind in range(6):
+        soundfile.write(str(wav_dir / "clip{}.wav".format(ind)),
+                        np.random.uniform(-0.5, 0.5, SR).astype(np.float32),
+                        SR)
+
+    # one training step on dummy data, so there is a checkpoint to score with
+    monkeypatch.setattr(sys, "argv", ["est_cli.py"] + est_cli_args(
+        "return", data_config, model_config, model_dir))
+    estimator = runpy.run_path(os.path.join(REPO_DIR, "est_cli.py"),
+                               run_name="__main__")["out"]
+    estimator.train(input_fn=lambda: (tf.zeros([2, 1, FREQS, 64]),
+                                      tf.zeros([2, 1], dtype=tf.int32)),
+                    steps=1)
+
+    # workers are spawned, so they import est_cli again; this used to hang
+    out_file = str(tmp_path / "scores.csv")
+    subprocess.run(
+        [sys.executable, "est_cli.py"] + est_cli_args(
+            "infer", data_config, model_config, model_dir) +
+        ["--wav_dir", str(wav_dir), "--out_file", out_file, "--workers", "2"],
+        cwd=REPO_DIR, check=True, timeout=600)
+
+    with open(out_file) as scores:
+        lines = scores.read().splitlines()
+    assert lines[0] == "file,probability"
+    assert sorted(os.path.basename(line.split(",")[0])
+                  for line in lines[1:]) == sorted(os.listdir(str(wav_dir)))
@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pytest
+import soundfile
+
+import make_tfrecords
+from make_tfrecords import chunk_dir
+
+
+SR = 8000
+
+
+def make_data_list(base_path):
+    """Short clips of different lengths, plus one over the 20 second limit."""
+    dataset_dir = os.path.join(base_path, "freefield")
+    os.makedirs(dataset_dir)
+    data_list = []
+    for ind, seconds in enumerate([1, 2, 1, 3, 21, 1, 2, 1, 1]):
+        filename = os.path.join(dataset_dir, "clip{}.wav".format(ind))
+        soundfile.write(filename, np.random.uniform(
+            -0.5, 0.5, seconds * SR).astype(np.float32), SR)
+        data_list.append((filename, ind % 2))
+    return data_list
+
+
+def read_outputs(out_dir):
+    """Contents of all files make_tfrecords left in out_dir, by name."""
+    outputs = dict()
+    for name in sorted(os.listdir(out_dir)):
+        with open(os.path.join(out_dir, name), mode="rb") as out_file:
+            outputs[name] = out_file.read()
+    return outputs
+
+
+def run(data_list, out_dir, **kwargs):
+    os.makedirs(out_dir)
+    make_tfrecords.make_tfrecords(data_list, os.path.join(out_dir, "records"),
+                                  dev_inds=[1, 6], n_augment=5, chunk_size=3,
+                                  **kwargs)
+    return read_outputs(out_dir)
+
+
+def test_resumed_run_gives_same_files(tmp_path, monkeypatch):
+    data_list = make_data_list(str(tmp_path / "data"))
+    clean = run(data_list, str(tmp_path / "clean"))
+
+    class Interrupted(Exception):
+        pass
+
+    mark_done = make_tfrecords.ProgressJournal.mark_done
+
+    def mark_first_done(journal, kind, chunk):
+        mark_done(journal, kind, chunk)
+        raise Interrupted()
+
+    out_dir = str(tmp_path / "resumed")
+    with monkeypatch.context() as patch:
+        patch.setattr(make_tfrecords.ProgressJournal, "mark_done",
+                      mark_first_done)
+        with pytest.raises(Interrupted):
+            run(data_list, out_dir)
+    assert os.path.isdir(chunk_dir(os.path.join(out_dir, "records")))
+
+    make_tfrecords.make_tfrecords(data_list, os.path.join(out_dir, "records"),
+                                  dev_inds=[1, 6], n_augment=5, chunk_size=3)
+    assert read_outputs(out_dir) == clean
+
+
+def test_workers_give_same_files(tmp_path):
+    data_list = make_data_list(str(tmp_path / "data"))
+    single = run(data_list, str(tmp_path / "single"))
+    assert run(data_list, str(tmp_path / "workers"), n_workers=2) == single
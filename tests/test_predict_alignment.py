@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import soundfile
+import tensorflow as tf
+
+from data_utils import file_id, find_tfrecords, match_predictions, read_index
+from est_input import make_dataset
+from est_models import model_fn
+from make_tfrecords import make_tfrecords
+
+
+SR = 8000
+
+
+def make_dev_set(base_path):
+    """Dev set with two clips over the 20 second limit, between others.
+
+    Labels of the clips that are kept alternate, so that any shift in
+    attribution changes them.
+    """
+    dataset_dir = os.path.join(base_path, "freefield")
+    os.makedirs(dataset_dir)
+    data_list = []
+    for ind, (seconds, label) in enumerate([(2, 1), (25, 0), (3, 0), (1, 1),
+                                            (21, 1), (2, 0)]):
+        filename = os.path.join(dataset_dir, "clip{}.wav".format(ind))
+        soundfile.write(filename, np.random.uniform(
+            -0.5, 0.5, seconds * SR).astype(np.float32), SR)
+        data_list.append((filename, label))
+    return data_list
+
+
+def predict_dev_set(data_path, model_config):
+    """Run the dev records through the input pipeline and model_fn.
+
+    Returns:
+        List of dicts with the predicted "id" and the label that came out of
+        the input pipeline with it, one per example, in order.
+    """
+    params = {"model_config": model_config, "act": tf.nn.relu,
+              "use_bn": False, "data_format": "channels_last",
+              "adam_args": [1e-3, 0.9, 0.9, 1e-8], "clipping": 0., "vis": 0,
+              "reg": 0., "onedim": True, "label_smoothing": 0.,
+              "normalize": False, "renorm": False, "use_avg": False}
+    predictions = []
+    with tf.Graph().as_default():
+        features, labels = make_dataset(
+            data_path, "dev", batch_size=3, freqs=1, augment=False,
+            threshold=False, with_ids=True).make_one_shot_iterator().get_next()
+        spec = model_fn(features, labels, tf.estimator.ModeKeys.PREDICT,
+                        params, config=None)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            try:
+                while True:
+                    ids, batch_labels = sess.run([spec.predictions["id"],
+                                                  labels])
+                    predictions += [{"id": example_id, "label": label[0]}
+                                    for example_id, label in zip(
+                                        ids, batch_labels)]
+            except tf.errors.OutOfRangeError:
+                pass
+    return predictions
+
+
+def test_predictions_match_files_with_long_clips(tmp_path):
+    data_list = make_dev_set(str(tmp_path / "data"))
+    out_path = str(tmp_path / "records")
+    make_tfrecords(data_list, out_path, dev_inds=range(len(data_list)),
+                   chunk_size=4)
+    model_config = str(tmp_path / "model_config")
+    with open(model_config, mode="w") as config_file:
+        config_file.write("layer,4,3,1\npool,1,2,2\nlayer,4,3,1")
+
+    predictions = predict_dev_set(out_path, model_config)
+    assert len(predictions) == 4  # the two long clips are skipped
+
+    dev_index = read_index(find_tfrecords(out_path, "dev"))
+    matched = list(match_predictions(
+        predictions, list(zip(dev_index["file"], dev_index["label"])),
+        dev_index["id"]))
+
+    files_by_id = {file_id(filename): (filename, label)
+                   for filename, label in data_list}
+    for prediction, filename, label in matched:
+        assert file_id(filename) == prediction["id"]
+        assert (filename, label) == files_by_id[prediction["id"]]
+        assert label == prediction["label"]
+    assert sorted(filename for _, filename, _ in matched) == sorted(
+        filename for ind, (filename, _) in enumerate(data_list)
+        if ind not in [1, 4])
+
+
+def test_predictions_without_ids_match_by_position():
+    dev_data = [("a.wav", 1), ("b.wav", 0), ("c.wav", 1)]
+    predictions = [{"id": -1} for _ in dev_data]
+    matched = list(match_predictions(predictions, dev_data, [-1, -1, -1]))
+    assert [(filename, label) for _, filename, label in matched] == dev_data
+    matched = list(match_predictions(predictions, dev_data))
+    assert [(filename, label) for _, filename, label in matched] == dev_data